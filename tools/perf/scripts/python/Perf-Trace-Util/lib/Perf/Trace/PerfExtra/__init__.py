@@ -0,0 +1,32 @@
+
+# Shared parts of the extra scripts (latency.py, count_between.py and
+# timeslot.py); each script only imports the modules it needs, those of
+# the options (fields, output, profile, live, snapshot and sampling)
+# once the options are set:
+#
+#   events   - event records, reordering and the per-key events holder
+#   stats    - statistics, quantiles and histograms
+#   fields   - tracepoint fields filtering and matching
+#   options  - the options common to the scripts
+#   output   - NumPy exports and events cache
+#   profile  - the stages profiling
+#   handlers - the per-event handlers given to perf
+#   live     - the wall clock and signals of the live mode
+#   snapshot - the snapshot files of the results (see merge.py)
+#   sampling - the trace time bounds and cycles sampling
+#
+# NumPy is only imported once a hot path needs it (its import alone
+# takes longer than loading a script).
+
+_numpy = False
+
+def numpy():
+    # The NumPy module, None when it is not installed
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        _numpy = module
+    return _numpy
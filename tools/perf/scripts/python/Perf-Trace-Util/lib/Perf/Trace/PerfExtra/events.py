@@ -0,0 +1,596 @@
+
+# The traced events: their records, their reordering by timestamp and
+# the holder processing them by key (cpu, task or command)
+
+import bisect
+import collections
+import heapq
+import itertools
+
+import PerfExtra
+
+from PerfExtra.options import KeyedOptions
+from PerfExtra.stats import Histogram, LogHistogram, Statistics
+
+class Event(object):
+    ARGS = ('name', 'context', 'cpu', 'nsecs', 'pid', 'comm')
+
+    # One instance is built per traced event: no per-instance dict,
+    # only the fixed ARGS slots (and the tag of matched cycles)
+    __slots__ = ARGS + ('tag',)
+
+    def __init__(self, name, context, cpu, nsecs, pid, comm, tag = None):
+        self.name = name
+        self.context = context
+        self.cpu = cpu
+        self.nsecs = nsecs
+        self.pid = pid
+        self.comm = comm
+        self.tag = tag
+
+class Reorder(object):
+    def __init__(self, window):
+        # Events are kept in a min-heap until they are older than the
+        # most recent one by more than the window (in ns)
+        self._window = window
+        self._heap = []
+        self._sequence = 0
+        self.newest = 0
+        self._released = 0
+        self.ready = []
+        self.late = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, event):
+        nsecs = event.nsecs
+
+        # An event older than an already released one arrived out of
+        # the window: it cannot be processed in order anymore
+        if nsecs < self._released:
+            self.late += 1
+            return
+
+        # The sequence number keeps the arrival order between events
+        # sharing a timestamp (and prevents comparing events)
+        heap = self._heap
+        heapq.heappush(heap, (nsecs, self._sequence, event))
+        self._sequence += 1
+
+        if nsecs > self.newest:
+            self.newest = nsecs
+
+        limit = self.newest - self._window
+        while heap and heap[0][0] <= limit:
+            self._released, _, event = heapq.heappop(heap)
+            self.ready.append(event)
+
+    def push_many(self, events):
+        # The whole block is sorted with the buffered events at once:
+        # the lateness is only checked against the previous releases
+        heap = self._heap
+        released = self._released
+        sequence = self._sequence
+        for event in events:
+            if event.nsecs < released:
+                self.late += 1
+                continue
+            heap.append((event.nsecs, sequence, event))
+            sequence += 1
+        self._sequence = sequence
+        if not heap:
+            return
+
+        # A sorted list is a valid heap: the released events are its
+        # head, up to the newest timestamp minus the window
+        heap.sort()
+        if heap[-1][0] > self.newest:
+            self.newest = heap[-1][0]
+        split = bisect.bisect_right(heap, (self.newest - self._window,
+                                           float('inf')))
+        if split:
+            self._released = heap[split - 1][0]
+            self.ready.extend([entry[2] for entry in heap[:split]])
+            del heap[:split]
+
+    def pop_ready(self):
+        ready = self.ready
+        self.ready = []
+        return ready
+
+    def release(self, until):
+        # Hand over all the events older than until, whatever the
+        # window (the later ones stay ready for the next batch)
+        heap = self._heap
+        while heap and heap[0][0] < until:
+            self._released, _, event = heapq.heappop(heap)
+            self.ready.append(event)
+
+        ready = self.ready
+        split = len(ready)
+        while split > 0 and ready[split - 1].nsecs >= until:
+            split -= 1
+        self.ready = ready[split:]
+        return ready[:split]
+
+    def oldest(self):
+        # The timestamp of the oldest pending event (None without any):
+        # the ready events are older than the buffered ones
+        if self.ready:
+            return self.ready[0].nsecs
+        return self._heap[0][0] if self._heap else None
+
+    def flush(self):
+        heap = self._heap
+        while heap:
+            self._released, _, event = heapq.heappop(heap)
+            self.ready.append(event)
+        return self.pop_ready()
+
+class ColumnReorder(object):
+    # Same as Reorder, over NumPy columns of (chain index, timestamp):
+    # the buffered events are sorted with each pushed block and the
+    # released ones are handed over at once
+    def __init__(self, window):
+        numpy = PerfExtra.numpy()
+        self._window = window
+        self._indexes = numpy.empty(0, dtype = numpy.int8)
+        self._times = numpy.empty(0, dtype = numpy.int64)
+        self.newest = 0
+        self._released = 0
+        self.late = 0
+
+    def __len__(self):
+        return len(self._times)
+
+    def push_many(self, indexes, times):
+        numpy = PerfExtra.numpy()
+        late = times < self._released
+        if late.any():
+            self.late += int(late.sum())
+            indexes = indexes[~late]
+            times = times[~late]
+
+        # The stable sort keeps the arrival order of simultaneous
+        # events, the buffered ones first
+        indexes = numpy.concatenate((self._indexes, indexes))
+        times = numpy.concatenate((self._times, times))
+        order = numpy.argsort(times, kind = 'mergesort')
+        indexes = indexes[order]
+        times = times[order]
+
+        if len(times) and times[-1] > self.newest:
+            self.newest = int(times[-1])
+        split = numpy.searchsorted(times, self.newest - self._window,
+                                   side = 'right')
+        if split:
+            self._released = int(times[split - 1])
+        self._indexes = indexes[split:]
+        self._times = times[split:]
+        return indexes[:split], times[:split]
+
+    def flush(self):
+        if len(self._times):
+            self._released = int(self._times[-1])
+        ready = (self._indexes, self._times)
+        self._indexes = self._indexes[:0]
+        self._times = self._times[:0]
+        return ready
+
+
+class Events:
+    # The events are processed by key, each key with its own reordering
+    # and results (an event is late when older than an already released
+    # event of its key: the other keys do not count); the scripts
+    # provide the processing itself:
+    # - _add_key(key, reorder) creates the processing of a new key (and
+    #   sets the results names) before calling this one
+    # - _update(key, events) processes the ordered events of a key and
+    #   returns the new values as (result name, values) items
+    # - _drop_key(key) forgets the processing of an evicted key
+    SIZE_THRESHOLD = 1024
+    # Pseudo key gathering the results of the evicted keys
+    OTHER = 'evicted'
+
+    def __init__(self, config, on_interval = None, raw = None):
+        self._config = config
+        # Every configured event name gets an integer id; any other
+        # event is rejected with a single lookup
+        self.ids = dict((n.replace(':', '__'), i)
+                        for i, n in enumerate(config.events))
+        self._id_names = [n.replace(':', '__') for n in config.events]
+        self._names = None
+
+        # The events are processed by key (cpu, task or command), each
+        # one with its own reordering and state machine
+        self._key = KeyedOptions.Key.ATTRIBUTES[config.key]
+        self._events = {}
+        self._statistics = {}
+        self._histograms = {} if self._config.histo else None
+
+        # The statistics and histograms above only cover the current
+        # interval, the previous ones are merged in the totals (in live
+        # mode, after staying in the rolling windows for a few periods)
+        self._total_statistics = {}
+        self._total_histograms = {}
+        self._rolling_statistics = collections.deque()
+        self._rolling_histograms = collections.deque()
+
+        # A key is evicted once idle or, when too many keys are
+        # tracked, if it is among the least recently seen ones: its
+        # results then go to the OTHER key
+        self._evicted_late = 0
+        self._idle_trigger = 0 if config.idle else float('inf')
+
+        # At each interval of trace time, the callback is given the
+        # events once everything before the interval end is processed
+        self._on_interval = on_interval
+        self._interval_start = None
+        self._interval_trigger = 0 if config.interval else float('inf')
+
+        # In live mode, the callback is rather given the events at each
+        # period of wall clock (or on request), the reported interval
+        # covering the rolling windows
+        self.clock = None
+        self._windows = 0
+        if config.live:
+            from PerfExtra.live import Clock
+            self.clock = Clock(config.live[0], config.window)
+            self._windows = config.live[1] - 1
+        self._live_start = None
+        self._live_starts = collections.deque()
+
+        # The raw values can be streamed as (key, name index, value)
+        self._raw = raw
+        self._raw_indexes = None
+
+    def _add_key(self, key, reorder = None):
+        # ...so, for each key, we create a reordering events
+        # container (the script creates the processing of the events
+        # and sets the results names before)...
+        self._events[key] = (reorder or Reorder)(self._config.window)
+
+        # ...a statistics processing instance...
+        self._statistics[key] = self._new_statistics()
+
+        # ...and a histogram instance
+        if self._config.histo:
+            self._histograms[key] = self._new_histograms()
+
+    def _new_statistics(self):
+        quantiles = self._config.percentiles is not None
+        return dict([(n, Statistics(quantiles = quantiles))
+                     for n in self.get_names()])
+
+    def _new_histograms(self):
+        if self._config.histo[0] == 'log':
+            histogram = lambda: LogHistogram(*self._config.histo[1:])
+        else:
+            histogram = lambda: Histogram(*self._config.histo)
+        return dict([(n, histogram()) for n in self.get_names()])
+
+    def _objects(self):
+        # The per-key results as (totals, currents, constructor, rolling)
+        objects = [(self._total_statistics, self._statistics,
+                    self._new_statistics, self._rolling_statistics)]
+        if self._config.histo:
+            objects.append((self._total_histograms, self._histograms,
+                            self._new_histograms, self._rolling_histograms))
+        return objects
+
+    def _process(self, key, events):
+        for _name, _values in self._update(key, events):
+            if self._raw is not None:
+                self._raw.extend((key, self._raw_index(_name)), _values)
+
+            self._statistics[key][_name].update_many(_values)
+
+            if self._config.histo:
+                self._histograms[key][_name].update_many(_values)
+
+    def _raw_index(self, name):
+        if self._raw_indexes is None:
+            self._raw_indexes = dict((n, i)
+                                     for i, n in enumerate(self.get_names()))
+        return self._raw_indexes[name]
+
+    def append(self, other):
+        nsecs = other.nsecs
+        if self.clock is not None:
+            self._live(nsecs)
+        if nsecs >= self._interval_trigger:
+            self._interval(nsecs)
+        if nsecs >= self._idle_trigger:
+            self._evict_idle(nsecs)
+
+        key = getattr(other, self._key)
+        # To prevent tricky cpu (or task) detection code, keys are
+        # discovered through the events...
+        if key not in self._events:
+            if len(self._events) >= self._config.lru:
+                self._evict_lru()
+            self._add_key(key)
+
+        events = self._events[key]
+        events.push(other)
+
+        # The released events are processed by batches
+        if len(events.ready) > Events.SIZE_THRESHOLD:
+            self._process(key, events.pop_ready())
+
+    def append_many(self, columns):
+        # Batch ingestion of parallel columns (name ids, cpus, nsecs,
+        # pids, comms), the ids being the self.ids ones (negative for
+        # unconfigured events): the events of each key are pushed as a
+        # single block
+        names = self._id_names
+        if self._config.interval or self._config.idle or self._config.live:
+            # The intervals, idle keys and clock are checked at each event
+            for row in itertools.izip(*columns):
+                if row[0] >= 0:
+                    self.append(Event(names[row[0]], None, *row[1:]))
+            return
+
+        name_ids, cpus, times, pids, comms = columns
+        keys = {'cpu': cpus, 'pid': pids, 'comm': comms}[self._key]
+        blocks = {}
+        for name_id, key, cpu, nsecs, pid, comm in \
+                itertools.izip(name_ids, keys, cpus, times, pids, comms):
+            if name_id < 0:
+                continue
+            block = blocks.get(key)
+            if block is None:
+                block = blocks[key] = []
+            block.append(Event(names[name_id], None, cpu, nsecs, pid, comm))
+
+        for key in sorted(blocks):
+            if key not in self._events:
+                if len(self._events) >= self._config.lru:
+                    self._evict_lru()
+                self._add_key(key)
+
+            events = self._events[key]
+            events.push_many(blocks[key])
+            if len(events.ready) > Events.SIZE_THRESHOLD:
+                self._process(key, events.pop_ready())
+
+    def _interval(self, nsecs):
+        interval = self._config.interval
+        if self._interval_start is None:
+            self._interval_start = nsecs
+            self._interval_trigger = nsecs + interval + self._config.window
+            return
+
+        # The interval is over once the reorder window went past its
+        # end: the older events can be processed
+        while nsecs >= self._interval_trigger:
+            start = self._interval_start
+            end = start + interval
+            for key, events in self._events.iteritems():
+                self._process(key, events.release(end))
+
+            if self._on_interval is not None:
+                self._on_interval(self, start, end)
+            self.checkpoint()
+
+            self._interval_start = end
+            self._interval_trigger += interval
+
+            # The following intervals without any pending event would
+            # only report nothing: they are skipped at once, up to the
+            # oldest pending event or the current interval
+            pending = [e.oldest() for e in self._events.itervalues()]
+            limit = min([p for p in pending if p is not None] +
+                        [nsecs - self._config.window])
+            if limit >= end + interval:
+                skipped = (limit - end) / interval * interval
+                self._interval_start += skipped
+                self._interval_trigger += skipped
+
+    def _live(self, nsecs):
+        if self._live_start is None:
+            self._live_start = nsecs
+        # Nothing to report before the first key
+        if not self.clock.tick(nsecs) or not self._events:
+            return
+
+        # Every key is processed up to the newest event of the trace
+        # (minus the window), the quiet ones included
+        end = self.clock.until()
+        for key, events in self._events.iteritems():
+            self._process(key, events.release(end))
+
+        start = self._live_starts[0] if self._live_starts \
+            else self._live_start
+        if self._on_interval is not None:
+            self._on_interval(self, start, max(start, end))
+
+        # A periodic report starts a new window, the oldest one leaving
+        # the rolling ones
+        if self.clock.periodic:
+            self.checkpoint()
+            self._live_starts.append(self._live_start)
+            self._live_start = max(self._live_start, end)
+            while len(self._live_starts) > self._windows:
+                self._live_starts.popleft()
+
+    def _evict_idle(self, nsecs):
+        # Checked once per idle period: the keys without any event
+        # during the last period are evicted
+        limit = nsecs - self._config.idle
+        for key in [k for k, e in self._events.iteritems() if e.newest < limit]:
+            self._evict(key)
+        self._idle_trigger = nsecs + self._config.idle
+
+    def _evict_lru(self):
+        # The least recently seen keys are evicted by batches (an
+        # eighth of the table) so that the sort is amortized
+        keys = sorted(self._events, key = lambda k: self._events[k].newest)
+        for key in keys[:max(1, len(keys) / 8)]:
+            self._evict(key)
+
+    def _evict(self, key):
+        # The pending events of the key are processed, then its results
+        # are merged into the OTHER key
+        self._flush_key(key)
+        self._evicted_late += self._events.pop(key).late
+        self._drop_key(key)
+
+        for totals, currents, new, rolling in self._objects():
+            for results in [currents, totals] + list(rolling):
+                if key not in results:
+                    continue
+                evicted = results.pop(key)
+                if Events.OTHER in results:
+                    for name, value in evicted.iteritems():
+                        results[Events.OTHER][name] += value
+                else:
+                    results[Events.OTHER] = evicted
+
+    def checkpoint(self, windows = None):
+        # The current statistics and histograms are restarted from
+        # scratch, the previous ones being kept in the rolling windows
+        # (none by default, out of the live mode) and the older ones
+        # merged into the totals
+        if windows is None:
+            windows = self._windows
+        for totals, currents, new, rolling in self._objects():
+            rolling.append(dict(currents))
+            while len(rolling) > windows:
+                for key, results in rolling.popleft().iteritems():
+                    if key in totals:
+                        for name, value in results.iteritems():
+                            totals[key][name] += value
+                    else:
+                        totals[key] = results
+            for key in currents.keys():
+                currents[key] = new()
+
+    def _flush_key(self, key):
+        self._process(key, self._events[key].flush())
+
+    def flush(self):
+        for key in self._events.keys():
+            self._flush_key(key)
+
+    def merge(self, other):
+        # Combine the (flushed) results of another instance, e.g. the
+        # cpus of a shard processed elsewhere
+        self.checkpoint(0)
+        other.checkpoint(0)
+
+        for key, events in other._events.iteritems():
+            if key not in self._events:
+                self._add_key(key)
+            self._events[key].late += events.late
+        self._evicted_late += other._evicted_late
+
+        for (totals, currents, new, _), (others, _, _, _) in \
+                zip(self._objects(), other._objects()):
+            for key, results in others.iteritems():
+                if key not in currents:
+                    currents[key] = new()
+                if key in totals:
+                    for name, value in results.iteritems():
+                        totals[key][name] += value
+                else:
+                    totals[key] = results
+
+    def get_state(self):
+        # The (flushed) results of every key, as saved in the snapshots
+        # (see snapshot.py)
+        from PerfExtra.snapshot import encode_histogram, encode_statistics
+        names = self.get_names()
+        keys = []
+        for key in self.get_keys()[:-1]:
+            statistics = [encode_statistics(self.get_statistics(key, n))
+                          for n in names]
+            histograms = None
+            if self._config.histo:
+                histograms = [encode_histogram(self.get_histogram(key, n))
+                              for n in names]
+            keys.append([key, self.get_late(key), statistics, histograms])
+        return {'names': names, 'keys': keys}
+
+    def restore(self, state, host = None):
+        # Add the results of a snapshot state, under their own keys or
+        # all under the host one
+        if self._names is None:
+            self._names = state['names']
+        if state['names'] != self.get_names():
+            raise ValueError('Snapshot of other events')
+        from PerfExtra.snapshot import decode_histogram, decode_statistics
+
+        for key, late, statistics, histograms in state['keys']:
+            target = key if host is None else host
+            if target == Events.OTHER:
+                self._evicted_late += late
+            else:
+                if target not in self._events:
+                    self._add_key(target)
+                self._events[target].late += late
+
+            if target not in self._statistics:
+                self._statistics[target] = self._new_statistics()
+            results = self._statistics[target]
+            for name, data in zip(self._names, statistics):
+                results[name] += decode_statistics(data)
+
+            if self._config.histo:
+                if target not in self._histograms:
+                    self._histograms[target] = self._new_histograms()
+                results = self._histograms[target]
+                for name, data in zip(self._names, histograms):
+                    results[name] += decode_histogram(data)
+
+    def get_scale(self):
+        # The factor of the reported counts: with sampling, they are
+        # estimated from the sampled cycles
+        return self._config.sample
+
+    def get_names(self):
+        if self._names is None:
+            raise ValueError('No events detected')
+        return self._names
+
+    def get_late(self, key):
+        if key == 'all':
+            return sum([e.late for e in self._events.values()]) + \
+                self._evicted_late
+        elif key == Events.OTHER:
+            return self._evicted_late
+        else:
+            return self._events[key].late
+
+    def get_keys(self):
+        keys = sorted([k for k in self._statistics if k != Events.OTHER])
+        if Events.OTHER in self._statistics:
+            keys.append(Events.OTHER)
+        return keys + ['all']
+
+    def get_key_ids(self):
+        # Integer ids of the keys for the binary exports: 'all' is -1,
+        # the evicted keys -2 and commands are given by their rank
+        ids = {'all': -1, Events.OTHER: -2}
+        for i, key in enumerate(self.get_keys()[:-1]):
+            ids.setdefault(key, key if isinstance(key, (int, long)) else i)
+        return ids
+
+    def _get(self, currents, rolling, totals, key, name, delta):
+        # The delta covers the current interval (and rolling windows)
+        keys = currents.keys() if key == 'all' else [key]
+        objects = [currents[k][name] for k in keys]
+        for results in rolling:
+            objects += [results[k][name] for k in keys if k in results]
+        if not delta:
+            objects += [totals[k][name] for k in keys if k in totals]
+        return reduce(lambda x, y: x + y, objects)
+
+    def get_statistics(self, key, name, delta = False):
+        return self._get(self._statistics, self._rolling_statistics,
+                         self._total_statistics, key, name, delta)
+
+    def get_histogram(self, key, name, delta = False):
+        return self._get(self._histograms, self._rolling_histograms,
+                         self._total_histograms, key, name, delta)
@@ -0,0 +1,26 @@
+
+# Filtering and matching of the events on their tracepoint fields,
+# compiled once into lambdas over the fields dict
+
+OPERATORS = ('==', '!=', '<=', '>=', '<', '>')
+
+def parse_value(value):
+    try:
+        return int(value, 0)
+    except ValueError:
+        return value
+
+def compile_filter(filters):
+    # The filters are compiled once into a single predicate over the
+    # fields dict; an event without a filtered field is kept
+    tests = ['({0!r} not in fields or fields[{0!r}] {1} {2!r})'.format(*f)
+             for f in filters]
+    return eval('lambda fields: ' + ' and '.join(tests))
+
+def compile_match(names):
+    # The tag of an event is its field value (or the tuple of them)
+    values = ['fields.get({!r})'.format(n) for n in names]
+    if len(values) == 1:
+        return eval('lambda fields: ' + values[0])
+    return eval('lambda fields: (' + ', '.join(values) + ')')
+
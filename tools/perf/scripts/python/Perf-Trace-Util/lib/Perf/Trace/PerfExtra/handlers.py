@@ -0,0 +1,69 @@
+
+# The per-event handlers given to perf
+
+import time
+
+import Util
+
+from PerfExtra.events import Event
+
+def new_handler(name, append, stats = None, start = 0, stop = float('inf'),
+                sampled = None, outside = None):
+    # Perf calls the <subsystem>__<event> function of an event, when the
+    # script has one, with the common fields (then the callchain and
+    # payload fields) as positional arguments: no fields dict is built
+    #
+    # The events out of the trace time bounds are rejected first, then
+    # the sampled out ones (the events sampled one by one, by their cpu
+    # and timestamp, see sampling.py); when profiling, the events out of
+    # the bounds are counted in outside (a profile stage statistics)
+    nsecs = Util.nsecs
+    clock = time.time
+
+    def handler(event_name, context, common_cpu, common_secs, common_nsecs,
+                common_pid, common_comm, *args):
+        append(Event(name, context, common_cpu,
+                     nsecs(common_secs, common_nsecs),
+                     common_pid, common_comm))
+
+    # The bounded (or sampled) runs only pay for the checks
+    def bounded(event_name, context, common_cpu, common_secs, common_nsecs,
+                common_pid, common_comm, *args):
+        _nsecs = nsecs(common_secs, common_nsecs)
+        if not start <= _nsecs < stop:
+            return
+        if sampled is not None and not sampled(common_cpu, _nsecs):
+            return
+        append(Event(name, context, common_cpu, _nsecs, common_pid,
+                     common_comm))
+
+    # When profiling, the calls are counted and sampled inline rather
+    # than through a wrapper (see Profile.time())
+    def profiled(event_name, context, common_cpu, common_secs, common_nsecs,
+                 common_pid, common_comm, *args):
+        stats[0] += 1
+        _nsecs = nsecs(common_secs, common_nsecs)
+        if not start <= _nsecs < stop:
+            outside[0] += 1
+            return
+        if sampled is not None and not sampled(common_cpu, _nsecs):
+            return
+        if stats[0] % Profile.SAMPLING:
+            append(Event(name, context, common_cpu, _nsecs, common_pid,
+                         common_comm))
+            return
+        begin = clock()
+        append(Event(name, context, common_cpu, _nsecs, common_pid,
+                     common_comm))
+        stats[2] += clock() - begin
+        stats[1] += 1
+
+    if stats is not None:
+        from PerfExtra.profile import Profile
+        if outside is None:
+            outside = [0]
+        return profiled
+    if start > 0 or stop < float('inf') or sampled is not None:
+        return bounded
+    return handler
+
@@ -0,0 +1,57 @@
+
+# The live mode (live= option): the scripts run along a live trace,
+# e.g. perf record -o - | perf script -s, so the wall clock drives the
+# reorder releases and the periodic reports, and signals request a
+# report on demand
+#
+# The scripts only run when perf gives them an event: a stalled trace
+# delays the reports until its next event.
+
+import signal
+import time
+
+class Clock(object):
+    def __init__(self, period, window):
+        # At each report, the events are released up to the newest one
+        # of the whole trace (minus the window), so that the quiet cpus
+        # (or tasks) do not hold their events back; the wall clock is not
+        # extrapolated to the trace: a live trace arrives by bursts
+        self.period = period
+        self._window = window
+        self._trigger = None
+        self._newest = 0
+        self.periodic = False
+        self.requested = False
+
+    def tick(self, nsecs):
+        # Whether a report is due: a periodic one (which then starts a
+        # new period) or a requested one
+        now = time.time()
+        # The first period starts with the first event
+        if self._trigger is None:
+            self._trigger = now + self.period
+        if nsecs > self._newest:
+            self._newest = nsecs
+
+        if now >= self._trigger:
+            self._trigger = now + self.period
+            self.periodic = True
+            return True
+        if self.requested:
+            self.requested = False
+            self.periodic = False
+            return True
+        return False
+
+    def until(self):
+        # The trace time before which every event is considered arrived
+        return self._newest - self._window
+
+def catch_signals(clock):
+    # SIGINT and SIGUSR1 request a report without stopping (the live
+    # trace ends with its producer); the interrupted reads are resumed
+    def request(signum, frame):
+        clock.requested = True
+    for signum in (signal.SIGINT, signal.SIGUSR1):
+        signal.signal(signum, request)
+        signal.siginterrupt(signum, False)
@@ -0,0 +1,302 @@
+
+# The options common to the scripts: each script extends the parsing
+# (see Options.parse()) with its own ones
+
+class Options:
+    class Events:
+        NAME = 'events='
+        @staticmethod
+        def check(arg):
+            return arg[:len(Options.Events.NAME)] == Options.Events.NAME
+        def __init__(self, arg):
+            self.config = arg[len(Options.Events.NAME):].split(',')
+
+    class Cache:
+        NAME = 'cache='
+        @staticmethod
+        def check(arg):
+            return arg[:len(Options.Cache.NAME)] == Options.Cache.NAME
+        def __init__(self, arg):
+            self.config = arg[len(Options.Cache.NAME):]
+
+    class Live:
+        NAME = 'live='
+        @staticmethod
+        def check(arg):
+            return arg[:len(Options.Live.NAME)] == Options.Live.NAME
+        def __init__(self, arg):
+            # Report period (wall clock seconds) and number of periods
+            # covered by each report
+            _arg = arg[len(Options.Live.NAME):].split(',')
+            period = float(_arg[0])
+            windows = int(_arg[1]) if len(_arg) > 1 else 1
+            if period <= 0 or windows < 1:
+                raise ValueError('The live period and windows count must '
+                                 'be positive')
+            self.config = (period, windows)
+
+    class Output:
+        NAME = 'output='
+        @staticmethod
+        def check(arg):
+            return arg[:len(Options.Output.NAME)] == Options.Output.NAME
+        def __init__(self, arg):
+            self.config = arg[len(Options.Output.NAME):]
+
+    class Profile:
+        NAME = 'profile'
+        @staticmethod
+        def check(arg):
+            return arg == Options.Profile.NAME
+
+    class Sample:
+        NAME = 'sample='
+        @staticmethod
+        def check(arg):
+            return arg[:len(Options.Sample.NAME)] == Options.Sample.NAME
+        def __init__(self, arg):
+            self.config = int(arg[len(Options.Sample.NAME):])
+            if not 1 <= self.config <= 65536:
+                raise ValueError('The sampling rate must be in [1, 65536]')
+
+    class Snapshot:
+        NAME = 'snapshot='
+        @staticmethod
+        def check(arg):
+            return arg[:len(Options.Snapshot.NAME)] == Options.Snapshot.NAME
+        def __init__(self, arg):
+            self.config = arg[len(Options.Snapshot.NAME):]
+
+    class Start:
+        NAME = 'start='
+        @staticmethod
+        def check(arg):
+            return arg[:len(Options.Start.NAME)] == Options.Start.NAME
+        def __init__(self, arg):
+            self.config = int(arg[len(Options.Start.NAME):])
+
+    class Stop:
+        NAME = 'stop='
+        @staticmethod
+        def check(arg):
+            return arg[:len(Options.Stop.NAME)] == Options.Stop.NAME
+        def __init__(self, arg):
+            self.config = int(arg[len(Options.Stop.NAME):])
+
+    class Window:
+        NAME = 'window='
+        @staticmethod
+        def check(arg):
+            return arg[:len(Options.Window.NAME)] == Options.Window.NAME
+        def __init__(self, arg):
+            self.config = int(arg[len(Options.Window.NAME):])
+            if self.config < 0:
+                raise ValueError('The window cannot be negative')
+
+    def __init__(self, args):
+        self.events = []
+        self.cache = None
+        self.live = None
+        self.output = None
+        self.profile = False
+        self.sample = 1
+        self.snapshot = None
+        self.start = 0
+        self.stop = float('inf')
+        self.window = 1000000 # 1ms
+
+        for arg in args:
+            if not self.parse(arg):
+                raise ValueError('Unsupported options: ' + arg)
+
+        if self.start >= self.stop:
+            raise ValueError('The start must be before the stop')
+
+    def parse(self, arg):
+        # Tell whether the argument is a known option (and apply it)
+        if Options.Cache.check(arg):
+            self.cache = Options.Cache(arg).config
+        elif Options.Events.check(arg):
+            self.events = Options.Events(arg).config
+        elif Options.Live.check(arg):
+            self.live = Options.Live(arg).config
+        elif Options.Output.check(arg):
+            self.output = Options.Output(arg).config
+        elif Options.Profile.check(arg):
+            self.profile = True
+        elif Options.Sample.check(arg):
+            self.sample = Options.Sample(arg).config
+        elif Options.Snapshot.check(arg):
+            self.snapshot = Options.Snapshot(arg).config
+        elif Options.Start.check(arg):
+            self.start = Options.Start(arg).config
+        elif Options.Stop.check(arg):
+            self.stop = Options.Stop(arg).config
+        elif Options.Window.check(arg):
+            self.window = Options.Window(arg).config
+        else:
+            return False
+        return True
+
+class KeyedOptions(Options):
+    # The options of the scripts processing the events by key (see
+    # events.Events)
+    class Filter:
+        NAME = 'filter='
+        @staticmethod
+        def check(arg):
+            return arg[:len(KeyedOptions.Filter.NAME)] == \
+                KeyedOptions.Filter.NAME
+        def __init__(self, arg):
+            from PerfExtra.fields import OPERATORS, parse_value
+            arg = arg[len(KeyedOptions.Filter.NAME):]
+            for operator in OPERATORS:
+                name, _, value = arg.partition(operator)
+                if value and name.replace('_', 'a').isalnum():
+                    self.config = (name, operator, parse_value(value))
+                    return
+            raise ValueError('A filter is given as field<op>value')
+
+    class Histo:
+        NAME = 'histo'
+        # The default buckets (a script may override them)
+        BUCKET = 1000
+        COUNT = 100
+        @staticmethod
+        def check(arg):
+            return arg[:len(KeyedOptions.Histo.NAME)] == \
+                KeyedOptions.Histo.NAME
+        def __init__(self, arg):
+            bucket = self.BUCKET
+            count = self.COUNT
+            name = KeyedOptions.Histo.NAME + '='
+            if arg != KeyedOptions.Histo.NAME and arg[:len(name)] != name:
+                raise ValueError('Unsupported options: ' + arg)
+            if arg[:len(name)] == name:
+                _arg = arg[len(name):].split(',')
+                if len(_arg) > 2:
+                    raise ValueError('A histogram is given as '
+                                     'histo[=bucket,count|=log,digits]')
+                if _arg[0] == 'log':
+                    # Each key and result holds its counters: about 5kB,
+                    # 35kB or 250kB for 1, 2 or 3 digits (25MB for 5)
+                    digits = int(_arg[1]) if len(_arg) > 1 else 2
+                    if not 1 <= digits <= 3:
+                        raise ValueError('Log histograms need 1 to 3 digits')
+                    self.config = ('log', digits)
+                    return
+                bucket = int(_arg[0])
+                if len(_arg) > 1:
+                    count = int(_arg[1])
+
+            self.config = (bucket, count)
+
+    class Idle:
+        NAME = 'idle='
+        @staticmethod
+        def check(arg):
+            return arg[:len(KeyedOptions.Idle.NAME)] == KeyedOptions.Idle.NAME
+        def __init__(self, arg):
+            self.config = int(arg[len(KeyedOptions.Idle.NAME):])
+            if self.config <= 0:
+                raise ValueError('The idle delay must be positive')
+
+    class Interval:
+        NAME = 'interval='
+        @staticmethod
+        def check(arg):
+            return arg[:len(KeyedOptions.Interval.NAME)] == \
+                KeyedOptions.Interval.NAME
+        def __init__(self, arg):
+            self.config = int(arg[len(KeyedOptions.Interval.NAME):])
+            if self.config <= 0:
+                raise ValueError('The interval must be positive')
+
+    class Key:
+        NAME = 'key='
+        # Event attribute of each key: the tracepoints common fields
+        # only carry the kernel task id, used for both pid and tid
+        ATTRIBUTES = {'cpu': 'cpu', 'pid': 'pid', 'tid': 'pid',
+                      'comm': 'comm'}
+        @staticmethod
+        def check(arg):
+            return arg[:len(KeyedOptions.Key.NAME)] == KeyedOptions.Key.NAME
+        def __init__(self, arg):
+            self.config = arg[len(KeyedOptions.Key.NAME):]
+            if self.config not in KeyedOptions.Key.ATTRIBUTES:
+                raise ValueError('The key must be one of: ' + ', '.join(
+                    sorted(KeyedOptions.Key.ATTRIBUTES)))
+
+    class Lru:
+        NAME = 'lru='
+        @staticmethod
+        def check(arg):
+            return arg[:len(KeyedOptions.Lru.NAME)] == KeyedOptions.Lru.NAME
+        def __init__(self, arg):
+            self.config = int(arg[len(KeyedOptions.Lru.NAME):])
+            if self.config <= 0:
+                raise ValueError('The keys table size must be positive')
+
+    class Percentiles:
+        NAME = 'percentiles'
+        @staticmethod
+        def check(arg):
+            return arg[:len(KeyedOptions.Percentiles.NAME)] == \
+                KeyedOptions.Percentiles.NAME
+        def __init__(self, arg):
+            percentiles = (50, 90, 99, 99.9)
+            name = KeyedOptions.Percentiles.NAME + '='
+            if arg[:len(name)] == name:
+                percentiles = [float(p) for p in arg[len(name):].split(',')]
+                if [p for p in percentiles if not 0 < p <= 100]:
+                    raise ValueError('Percentiles must be in ]0, 100]')
+
+            self.config = tuple(sorted(percentiles))
+
+    class Raw:
+        NAME = 'raw'
+        @staticmethod
+        def check(arg):
+            return arg == KeyedOptions.Raw.NAME
+
+    def __init__(self, args):
+        self.filters = []
+        self.histo = None
+        self.idle = None
+        self.interval = None
+        self.key = 'cpu'
+        self.lru = 4096
+        self.percentiles = None
+        self.raw = False
+
+        Options.__init__(self, args)
+
+        if self.raw and not self.output:
+            raise ValueError('Raw values need an output prefix')
+
+        if self.raw and self.key == 'comm':
+            raise ValueError('Raw values need a numeric key')
+
+        if self.live and self.interval:
+            raise ValueError('The live mode replaces the intervals')
+
+    def parse(self, arg):
+        if KeyedOptions.Filter.check(arg):
+            self.filters.append(KeyedOptions.Filter(arg).config)
+        elif KeyedOptions.Histo.check(arg):
+            self.histo = self.Histo(arg).config
+        elif KeyedOptions.Idle.check(arg):
+            self.idle = KeyedOptions.Idle(arg).config
+        elif KeyedOptions.Interval.check(arg):
+            self.interval = KeyedOptions.Interval(arg).config
+        elif KeyedOptions.Key.check(arg):
+            self.key = KeyedOptions.Key(arg).config
+        elif KeyedOptions.Lru.check(arg):
+            self.lru = KeyedOptions.Lru(arg).config
+        elif KeyedOptions.Percentiles.check(arg):
+            self.percentiles = KeyedOptions.Percentiles(arg).config
+        elif KeyedOptions.Raw.check(arg):
+            self.raw = True
+        else:
+            return Options.parse(self, arg)
+        return True
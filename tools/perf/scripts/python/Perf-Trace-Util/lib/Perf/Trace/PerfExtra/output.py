@@ -0,0 +1,181 @@
+
+# Exports of the results (NumPy and CSV files) and cache of the
+# traced events (see replay.py)
+
+import array
+import csv
+import struct
+import sys
+
+from PerfExtra.stats import LogHistogram
+
+class NpyWriter:
+    # Rows of integer columns (C longs) are buffered then appended to
+    # a NPY file; the header (and its shape) is rewritten when closing
+    CHUNK = 65536
+    HEADER_SIZE = 128
+
+    def __init__(self, path, columns):
+        self._file = open(path, 'wb')
+        self._columns = columns
+        self._rows = 0
+        self._buffer = array.array('l')
+        self._write_header()
+
+    def _write_header(self):
+        order = '<' if sys.byteorder == 'little' else '>'
+        header = "{'descr': '%si%d', 'fortran_order': False, " \
+            "'shape': (%d, %d), }" % (order, self._buffer.itemsize,
+                                      self._rows, self._columns)
+        header = header.ljust(NpyWriter.HEADER_SIZE - 11) + '\n'
+        self._file.write('\x93NUMPY\x01\x00' + struct.pack('<H', len(header)))
+        self._file.write(header)
+
+    def _flush(self):
+        self._buffer.tofile(self._file)
+        self._buffer = array.array('l')
+
+    def append(self, row):
+        self._buffer.extend(row)
+        self._rows += 1
+        if len(self._buffer) >= NpyWriter.CHUNK:
+            self._flush()
+
+    def extend(self, prefix, values):
+        # One row per value, each starting with the same columns
+        buffer = self._buffer
+        for value in values:
+            buffer.extend(prefix)
+            buffer.append(value)
+        self._rows += len(values)
+        if len(buffer) >= NpyWriter.CHUNK:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self._file.seek(0)
+        self._write_header()
+        self._file.close()
+
+def export_stats(events, prefix):
+    names = events.get_names()
+    keys = events.get_keys()
+    percentiles = events._config.percentiles or ()
+
+    ids = events.get_key_ids()
+    scale = events.get_scale()
+
+    header = [events._config.key, 'name', 'count', 'min', 'avg', 'max', 'sum']
+    header += ['p{:g}'.format(p) for p in percentiles]
+    # The binary version refers to the keys by id (see get_key_ids())
+    # and to the names by index
+    binary = NpyWriter(prefix + '.stats.npy', len(header))
+
+    with open(prefix + '.stats.csv', 'wb') as output:
+        table = csv.writer(output)
+        table.writerow(header)
+        for key in keys:
+            for i, name in enumerate(names):
+                stats = events.get_statistics(key, name)
+                _min, _max, _avg = stats.get_values()
+                values = [stats.count * scale, _min, _avg, _max,
+                          stats.sum * scale]
+                if percentiles:
+                    values += stats.get_percentiles(percentiles)
+                table.writerow([key, name] + values)
+                binary.append([ids[key], i] + values)
+    binary.close()
+
+def export_histograms(events, prefix):
+    names = events.get_names()
+    keys = events.get_keys()
+
+    # One row per non-empty bucket (given by its lower bound), the
+    # overflows are given as bucket -1
+    ids = events.get_key_ids()
+    scale = events.get_scale()
+
+    header = [events._config.key, 'name', 'bucket', 'count']
+    binary = NpyWriter(prefix + '.histo.npy', len(header))
+
+    with open(prefix + '.histo.csv', 'wb', 1 << 20) as output:
+        table = csv.writer(output)
+        table.writerow(header)
+        for key in keys:
+            for i, name in enumerate(names):
+                histogram = events.get_histogram(key, name)
+                if isinstance(histogram, LogHistogram):
+                    buckets = histogram.get_buckets()
+                else:
+                    buckets = [b * histogram.step for b in histogram.buckets]
+                values = zip(buckets, histogram.get_values())
+                values.append((-1, histogram.overflow))
+                for bucket, count in values:
+                    if count == 0:
+                        continue
+                    count *= scale
+                    table.writerow([key, name, bucket, count])
+                    binary.append([ids[key], i,
+                                   bucket, count])
+    binary.close()
+
+# --- Cache part ---
+
+class Cache:
+    # Every traced event is stored as (name id, cpu, nsecs, pid, comm
+    # id) by chunks of columns; the names and comms tables are written
+    # at the end of the file (see replay.py)
+    #
+    # The columns are in the host layout, given in the header by their
+    # typecodes, their item sizes and the byte order ('<' or '>')
+    MAGIC = 'PXCACHE2'
+    TYPECODES = 'HHLlL'
+    CHUNK = 65536
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(Cache.MAGIC + Cache.TYPECODES)
+        self._file.write(''.join([chr(array.array(t).itemsize)
+                                  for t in Cache.TYPECODES]))
+        self._file.write('<' if sys.byteorder == 'little' else '>')
+        self._names = {}
+        self._comms = {}
+        self._columns = [array.array(t) for t in Cache.TYPECODES]
+
+    def _flush(self):
+        count = len(self._columns[0])
+        if count == 0:
+            return
+        self._file.write(struct.pack('<I', count))
+        for column in self._columns:
+            column.tofile(self._file)
+        self._columns = [array.array(t) for t in Cache.TYPECODES]
+
+    def append(self, name, cpu, nsecs, pid, comm):
+        name_id = self._names.get(name)
+        if name_id is None:
+            name_id = self._names[name] = len(self._names)
+        comm_id = self._comms.get(comm)
+        if comm_id is None:
+            comm_id = self._comms[comm] = len(self._comms)
+
+        names, cpus, times, pids, comms = self._columns
+        names.append(name_id)
+        cpus.append(cpu)
+        times.append(nsecs)
+        pids.append(pid)
+        comms.append(comm_id)
+
+        if len(names) >= Cache.CHUNK:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        tables = []
+        for table in (self._names, self._comms):
+            strings = sorted(table.keys(), key = lambda s: table[s])
+            tables.append('\0'.join(strings))
+        self._file.write(tables[0] + tables[1])
+        self._file.write(struct.pack('<QQ', len(tables[0]), len(tables[1])))
+        self._file.close()
+
@@ -0,0 +1,69 @@
+
+# Profiling of the script stages (see the profile option)
+
+import time
+
+class Profile:
+    # The per-event stages are only timed once every SAMPLING calls to
+    # keep the overhead low; their total time is extrapolated
+    SAMPLING = 64
+
+    def __init__(self):
+        self.start = time.time()
+        self.timings = {}
+        self.peaks = {}
+        self.sorted = 0
+
+    def stats(self, name):
+        # The stage [calls, timed calls, timed seconds]
+        return self.timings.setdefault(name, [0, 0, 0.0])
+
+    def time(self, name, function, sampling = 1, probe = None):
+        # Wrap the function of a stage: the calls are counted, the
+        # sampled ones timed
+        stats = self.stats(name)
+        clock = time.time
+
+        def timed(*args):
+            stats[0] += 1
+            if stats[0] % sampling:
+                return function(*args)
+            if probe is not None:
+                probe(*args)
+            start = clock()
+            result = function(*args)
+            stats[2] += clock() - start
+            stats[1] += 1
+            return result
+        return timed
+
+    def peak(self, key, length):
+        if length > self.peaks.get(key, 0):
+            self.peaks[key] = length
+
+    def get_calls(self, name):
+        return self.timings.get(name, [0])[0]
+
+    def get_seconds(self, name):
+        calls, timed, seconds = self.timings.get(name, [0, 0, 0.0])
+        return seconds * calls / timed if timed else 0.0
+
+def print_profile_stages(profile, stages, outside):
+    # The stages nest (e.g. the appends are part of the handlers): the
+    # time outside of the script stages is spent in perf itself
+    wall = time.time() - profile.start
+    seen = profile.get_calls('unhandled') + profile.get_calls('handlers')
+    print ' wall time : {:.3f}s ({:d} events/s)'.format(
+        wall, int(seen / wall) if wall else 0)
+    print ' seen      : {:010d}'.format(seen)
+
+    print '# stage      calls      timed  seconds  us/call'
+    for name in stages:
+        calls = profile.get_calls(name)
+        seconds = profile.get_seconds(name)
+        print ' {:<9}: {:010d} {:010d} {:8.3f} {:8.2f}'.format(
+            name, calls, profile.timings.get(name, [0, 0])[1], seconds,
+            seconds * 1e6 / calls if calls else 0.0)
+    inside = sum([profile.get_seconds(n) for n in outside])
+    print ' {:<9}: {:>21} {:8.3f}'.format('perf', '', max(wall - inside, 0.0))
+
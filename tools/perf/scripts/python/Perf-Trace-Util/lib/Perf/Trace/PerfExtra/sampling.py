@@ -0,0 +1,88 @@
+
+# Trace time bounds and cycles sampling (start=, stop= and sample=
+# options): the events out of the bounds are rejected before any
+# processing, the cycles are sampled by their state machine and the
+# reports scale the sampled counts by the rate
+#
+# A cycle is identified by its key and its first timestamp: 1 in rate
+# cycles is kept, by a hash of that identity, whole and the same way on
+# every run, shard or host. The scalar and NumPy hashes agree.
+
+import itertools
+import zlib
+
+import PerfExtra
+
+MASK = 0xffffffffffffffff
+GOLDEN = 0x9e3779b97f4a7c15
+
+# Keys remembered by a sampler (the commands may be many)
+CACHED = 65536
+
+def get_seed(key):
+    # The hash seed of a key; the integer keys (cpus, tasks) are their
+    # own value, so that NumPy columns of them can be seeded at once
+    if not isinstance(key, (int, long)):
+        key = zlib.crc32(str(key)) & 0xffffffff
+    return ((key + 1) * GOLDEN) & MASK
+
+def mix(value):
+    # The 64-bit finalizer of MurmurHash3: every input bit flips half of
+    # the output ones, whatever the timestamps granularity
+    value ^= value >> 33
+    value = (value * 0xff51afd7ed558ccd) & MASK
+    value ^= value >> 33
+    value = (value * 0xc4ceb9fe1a85ec53) & MASK
+    value ^= value >> 33
+    return value
+
+def is_sampled(rate, seed, nsecs):
+    # Whether the cycle starting at nsecs, of the key with this seed, is
+    # kept (the state machines keep the seed of their key: they are
+    # pickled by the parallel replays)
+    return mix(nsecs ^ seed) % rate == 0
+
+def new_sampler(rate):
+    # Same as is_sampled(), for any key: sampled(key, nsecs)
+    seeds = {}
+
+    def sampled(key, nsecs):
+        seed = seeds.get(key)
+        if seed is None:
+            seed = get_seed(key)
+            if len(seeds) < CACHED:
+                seeds[key] = seed
+        return mix(nsecs ^ seed) % rate == 0
+
+    return sampled
+
+def sampled_columns(rate, keys, times):
+    # Same as a sampler, over a NumPy column of timestamps with a single
+    # key or a column of integer keys
+    numpy = PerfExtra.numpy()
+    uint64 = numpy.uint64
+    if isinstance(keys, numpy.ndarray):
+        seeds = (keys.astype(uint64) + uint64(1)) * uint64(GOLDEN)
+    else:
+        seeds = uint64(get_seed(keys))
+    values = numpy.asarray(times).astype(uint64) ^ seeds
+    values ^= values >> uint64(33)
+    values *= uint64(0xff51afd7ed558ccd)
+    values ^= values >> uint64(33)
+    values *= uint64(0xc4ceb9fe1a85ec53)
+    values ^= values >> uint64(33)
+    return values % uint64(rate) == 0
+
+def new_selector(start, stop, sampled = None):
+    # The events of a block of columns within the bounds (and sampled
+    # in, each one by its cpu and timestamp), None when there is none
+    def select(columns):
+        if sampled is None:
+            rows = [r for r in itertools.izip(*columns)
+                    if start <= r[2] < stop]
+        else:
+            rows = [r for r in itertools.izip(*columns)
+                    if start <= r[2] < stop and sampled(r[1], r[2])]
+        return zip(*rows) if rows else None
+
+    return select
@@ -0,0 +1,106 @@
+
+# Snapshots of the results of a run (snapshot= option), combined with
+# the ones of other runs or hosts by merge.py, without the traces
+#
+# A snapshot file holds a magic, the format version and the compressed
+# JSON of the script name, its options, the host and the results state
+# of the script holder (see Events.get_state()). The counters are
+# stored sparsely, by non-zero buckets: the size and the merge time
+# follow the buckets in use, not the traced events.
+
+import json
+import socket
+import struct
+import zlib
+
+from PerfExtra.stats import Histogram, LogHistogram, Statistics
+
+MAGIC = 'PXSNAP'
+VERSION = 1
+
+# Options only affecting how a run is done or written, not the shape of
+# its results: the snapshots of runs differing by them can be merged
+RUN_OPTIONS = ('cache=', 'idle=', 'interval=', 'live=', 'lru=', 'output=',
+               'profile', 'raw', 'snapshot=', 'start=', 'stop=', 'stream',
+               'window=')
+
+def get_shape(options):
+    # The options the results depend on
+    return sorted([o for o in options
+                   if not [r for r in RUN_OPTIONS if o.startswith(r)]])
+
+def encode_counters(counters):
+    indexes = [i for i, count in enumerate(counters) if count]
+    return [indexes, [counters[i] for i in indexes]]
+
+def decode_counters(counters, data):
+    for index, count in zip(*data):
+        counters[index] += count
+
+def encode_statistics(stats):
+    quantiles = None
+    if stats.quantiles is not None:
+        buckets = stats.quantiles.buckets
+        indexes = sorted(buckets)
+        quantiles = [stats.quantiles.count, indexes,
+                     [buckets[i] for i in indexes]]
+    return [stats.min, stats.max, stats.sum, stats.count, quantiles]
+
+def decode_statistics(data):
+    stats = Statistics(quantiles = data[4] is not None)
+    stats.min, stats.max, stats.sum, stats.count = data[:4]
+    if data[4] is not None:
+        count, indexes, counts = data[4]
+        stats.quantiles.count = count
+        stats.quantiles.buckets = dict(zip(indexes, counts))
+    return stats
+
+def encode_histogram(histogram):
+    if isinstance(histogram, LogHistogram):
+        shape = ['log', histogram.digits]
+    else:
+        shape = ['linear', histogram.step, histogram.count]
+    return shape + [histogram.overflow, histogram.total,
+                    encode_counters(histogram.histo)]
+
+def decode_histogram(data):
+    if data[0] == 'log':
+        histogram = LogHistogram(data[1])
+    else:
+        histogram = Histogram(data[1], data[2])
+    histogram.overflow, histogram.total, counters = data[-3:]
+    decode_counters(histogram.histo, counters)
+    return histogram
+
+def to_str(value):
+    # The strings are written as their latin-1 decoding (the commands
+    # are bytes of any encoding) and read back as such
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    if isinstance(value, list):
+        return [to_str(v) for v in value]
+    if isinstance(value, dict):
+        return dict((to_str(k), to_str(v)) for k, v in value.iteritems())
+    return value
+
+def save(path, script, options, holder, host = None):
+    snapshot = {'script': script, 'options': options,
+                'host': host or socket.gethostname(),
+                'state': holder.get_state()}
+    with open(path, 'wb') as output:
+        output.write(MAGIC + struct.pack('<H', VERSION))
+        text = json.dumps(snapshot, encoding = 'latin-1',
+                          separators = (',', ':'))
+        output.write(zlib.compress(text))
+
+def load(path):
+    with open(path, 'rb') as input:
+        data = input.read()
+    header = len(MAGIC) + struct.calcsize('<H')
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a snapshot: ' + path)
+    version, = struct.unpack('<H', data[len(MAGIC):header])
+    if version != VERSION:
+        raise ValueError('Unsupported snapshot version {}: {}'.format(
+            version, path))
+    return to_str(json.loads(zlib.decompress(data[header:])))
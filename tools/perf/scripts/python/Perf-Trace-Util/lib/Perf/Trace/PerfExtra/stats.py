@@ -0,0 +1,305 @@
+
+# Statistics, quantiles and histograms of the latencies (or counts)
+
+import array
+import itertools
+import math
+
+import PerfExtra
+
+def new_counters(count):
+    # Contiguous unsigned counters: cheap to increment one by one and,
+    # when NumPy is available, processed in place through views
+    return array.array('L', [0]) * count
+
+def view_counters(counters):
+    numpy = PerfExtra.numpy()
+    return numpy.frombuffer(counters, dtype = numpy.dtype(counters.typecode))
+
+def add_counters(counters, other):
+    if len(other) > 0 and PerfExtra.numpy() is not None:
+        view_counters(counters)[:len(other)] += view_counters(other)
+    else:
+        for i, count in enumerate(other):
+            if count:
+                counters[i] += count
+
+def count_indexes(counters, indexes):
+    # Accumulate a NumPy array of in-range bucket indexes
+    numpy = PerfExtra.numpy()
+    bins = numpy.bincount(indexes, minlength = len(counters))
+    view_counters(counters)[:] += bins.astype(numpy.dtype(counters.typecode))
+
+def log_index(value, bits):
+    # Log-linear buckets (HDR-like): below 2^bits a bucket holds a
+    # single value, above the bucket width doubles with each power of
+    # two so that the relative error stays under 2^-(bits-1)
+    if value < (1 << bits):
+        return value if value > 0 else 0
+    shift = value.bit_length() - bits
+    return (shift << (bits - 1)) + (value >> shift)
+
+def log_lower(index, bits):
+    # Smallest value of a log_index() bucket
+    if index < (1 << bits):
+        return index
+    shift = (index >> (bits - 1)) - 1
+    return (index - (shift << (bits - 1))) << shift
+
+class Quantiles(object):
+    BITS = 8
+
+    def __init__(self, quantiles = None):
+        if quantiles is None:
+            self.buckets = {}
+            self.count = 0
+        else:
+            self.buckets = dict(quantiles.buckets)
+            self.count = quantiles.count
+
+    def __iadd__(self, other):
+        buckets = self.buckets
+        for index, count in other.buckets.iteritems():
+            buckets[index] = buckets.get(index, 0) + count
+        self.count += other.count
+        return self
+
+    def __add__(self, other):
+        result = Quantiles(quantiles = self)
+        result += other
+        return result
+
+    def update(self, value):
+        index = log_index(int(value), Quantiles.BITS)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+
+    def update_many(self, values):
+        buckets = self.buckets
+        if not isinstance(values, (list, tuple)):
+            # Vectorized log_index() over a NumPy array (see
+            # LogHistogram.update_many())
+            numpy = PerfExtra.numpy()
+            values = numpy.maximum(values, 0)
+            shift = numpy.maximum(numpy.frexp(values)[1] - Quantiles.BITS, 0)
+            indexes = (shift << (Quantiles.BITS - 1)) + (values >> shift)
+            indexes, counts = numpy.unique(indexes, return_counts = True)
+            for index, count in itertools.izip(indexes.tolist(),
+                                               counts.tolist()):
+                buckets[index] = buckets.get(index, 0) + count
+        else:
+            for value in values:
+                index = log_index(int(value), Quantiles.BITS)
+                buckets[index] = buckets.get(index, 0) + 1
+        self.count += len(values)
+
+    def get_values(self, percentiles):
+        # The buckets are walked once for all the (sorted) percentiles;
+        # each value is the middle of the bucket holding its rank
+        result = []
+        indexes = sorted(self.buckets.keys())
+        position = 0
+        seen = 0
+        for percentile in percentiles:
+            rank = max(1, int(math.ceil(percentile * self.count / 100.0)))
+            while position < len(indexes) and seen < rank:
+                seen += self.buckets[indexes[position]]
+                position += 1
+            if position == 0:
+                result.append(0)
+                continue
+            index = indexes[position - 1]
+            lower = log_lower(index, Quantiles.BITS)
+            upper = log_lower(index + 1, Quantiles.BITS) - 1
+            result.append((lower + upper) / 2)
+        return result
+
+class Statistics:
+    def __init__(self, stats = None, quantiles = False):
+        if stats is None:
+            self.min = 1000000000
+            self.max = 0
+            self.sum = 0
+            self.count = 0
+            self.quantiles = Quantiles() if quantiles else None
+        else:
+            self.min = stats.min
+            self.max = stats.max
+            self.sum = stats.sum
+            self.count = stats.count
+            self.quantiles = None if stats.quantiles is None \
+                else Quantiles(quantiles = stats.quantiles)
+
+    def __iadd__(self, other):
+        if other.min < self.min:
+            self.min = other.min
+        if other.max > self.max:
+            self.max = other.max
+        self.sum += other.sum
+        self.count += other.count
+        if self.quantiles is not None:
+            self.quantiles += other.quantiles
+        return self
+
+    def __add__(self, other):
+        result = Statistics(stats = self)
+        result += other
+        return result
+
+    def update(self, value):
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.sum += value
+        self.count += 1
+        if self.quantiles is not None:
+            self.quantiles.update(value)
+
+    def update_many(self, values):
+        if len(values) == 0:
+            return
+        if not isinstance(values, (list, tuple)):
+            # A NumPy array (see PairLatencies)
+            low = int(values.min())
+            high = int(values.max())
+            total = int(values.sum())
+        else:
+            low = min(values)
+            high = max(values)
+            total = sum(values)
+        if low < self.min:
+            self.min = low
+        if high > self.max:
+            self.max = high
+        self.sum += total
+        self.count += len(values)
+        if self.quantiles is not None:
+            self.quantiles.update_many(values)
+
+    def get_values(self):
+        result = (0 , 0, 0) if self.count == 0 else \
+            (self.min, self.max, self.sum / self.count)
+        return result
+
+    def get_percentiles(self, percentiles):
+        # The estimations are kept within the observed range
+        values = self.quantiles.get_values(percentiles)
+        return [min(max(v, self.min), self.max) if self.count else 0
+                for v in values]
+
+class Histogram:
+    def __init__(self, bucket_size = 10, buckets_count = 20, histo = None):
+        if histo is None:
+            self.step = bucket_size
+            self.count = buckets_count
+            self.buckets = [i for i in xrange(self.count)]
+            self.histo = new_counters(self.count)
+            self.overflow = 0
+            self.total = 0
+        else:
+            self.step = histo.step
+            self.count = histo.count
+            self.buckets = histo.buckets
+            self.histo = array.array(histo.histo.typecode, histo.histo)
+            self.overflow = histo.overflow
+            self.total = histo.total
+
+    def __iadd__(self, other):
+        add_counters(self.histo, other.histo)
+        self.overflow += other.overflow
+        self.total += other.total
+        return self
+
+    def __add__(self, other):
+        result = Histogram(histo = self)
+        result += other
+        return result
+
+    def update(self, value):
+        index = int(value / self.step)
+        if index < self.count:
+            self.histo[index] += 1
+        else:
+            self.overflow += 1
+        self.total += 1
+
+    def update_many(self, values):
+        numpy = PerfExtra.numpy()
+        if numpy is None:
+            for value in values:
+                self.update(value)
+            return
+
+        indexes = numpy.asarray(values, dtype = numpy.int64) // self.step
+        inside = indexes[indexes < self.count]
+        count_indexes(self.histo, inside)
+        self.overflow += len(indexes) - len(inside)
+        self.total += len(indexes)
+
+    def get_values(self):
+        return self.histo
+
+class LogHistogram:
+    # Values above 2^MAX_BITS ns (~18 min) are overflows
+    MAX_BITS = 40
+
+    def __init__(self, digits = 2, histo = None):
+        if histo is None:
+            # The sub-buckets resolve the requested significant digits
+            self.digits = digits
+            self.bits = int(math.ceil(math.log(2 * 10 ** digits, 2)))
+            self.count = log_index((1 << LogHistogram.MAX_BITS) - 1,
+                                   self.bits) + 1
+            self.histo = array.array('L', [0]) * self.count
+            self.overflow = 0
+            self.total = 0
+        else:
+            self.digits = histo.digits
+            self.bits = histo.bits
+            self.count = histo.count
+            self.histo = array.array('L', histo.histo)
+            self.overflow = histo.overflow
+            self.total = histo.total
+
+    def __iadd__(self, other):
+        add_counters(self.histo, other.histo)
+        self.overflow += other.overflow
+        self.total += other.total
+        return self
+
+    def __add__(self, other):
+        result = LogHistogram(histo = self)
+        result += other
+        return result
+
+    def update(self, value):
+        index = log_index(int(value), self.bits)
+        if index < self.count:
+            self.histo[index] += 1
+        else:
+            self.overflow += 1
+        self.total += 1
+
+    def update_many(self, values):
+        numpy = PerfExtra.numpy()
+        if numpy is None:
+            for value in values:
+                self.update(value)
+            return
+
+        # Vectorized log_index(): the exponent of the float conversion
+        # is the bit length (exact in the histogram range)
+        values = numpy.maximum(numpy.asarray(values, dtype = numpy.int64), 0)
+        shift = numpy.maximum(numpy.frexp(values)[1] - self.bits, 0)
+        indexes = (shift << (self.bits - 1)) + (values >> shift)
+        inside = indexes[indexes < self.count]
+        count_indexes(self.histo, inside)
+        self.overflow += len(indexes) - len(inside)
+        self.total += len(indexes)
+
+    def get_buckets(self):
+        return [log_lower(i, self.bits) for i in xrange(self.count)]
+
+    def get_values(self):
+        return self.histo
@@ -0,0 +1,69 @@
+
+# Micro-benchmark of the Event record built for each traced event
+#
+# usage: python bench/event.py [count]
+
+import imp
+import os
+import sys
+import timeit
+import types
+
+# The scripts import Util from the perf installation; a stub is
+# enough to load them outside of perf
+if 'Util' not in sys.modules:
+    Util = types.ModuleType('Util')
+    Util.nsecs = lambda secs, nsecs: secs * 1000000000 + nsecs
+    sys.modules['Util'] = Util
+os.environ.setdefault('PERF_EXEC_PATH', '')
+
+SCRIPTS = ('latency', 'count_between', 'timeslot')
+ARGS = ('sched__sched_switch', None, 3, 1234567890123, 4242, 'swapper/3')
+
+# --- Reference part ---
+
+class LegacyEvent:
+    ARGS = ('name', 'context', 'cpu', 'nsecs', 'pid', 'comm')
+
+    def __init__(self, *args, **keywords):
+        assert len(args) == len(LegacyEvent.ARGS)
+
+        for i, arg in enumerate(LegacyEvent.ARGS):
+            setattr(self, arg, args[i])
+
+        for key, value in keywords.iteritems():
+            setattr(self, key, value)
+
+# --- Measurement part ---
+
+def load_script(name):
+    path = os.path.join(os.path.dirname(__file__), '..', name + '.py')
+    return imp.load_source('bench_' + name, path)
+
+def rate(cls, count):
+    elapsed = min(timeit.repeat(lambda: cls(*ARGS), number=count, repeat=3))
+    return count / elapsed
+
+def size(cls):
+    event = cls(*ARGS)
+    result = sys.getsizeof(event)
+    if hasattr(event, '__dict__'):
+        result += sys.getsizeof(event.__dict__)
+    return result
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    print '# === Event construction ({} events) ==='.format(count)
+    print '# {:<16} {:>12} {:>8}'.format('record', 'events/s', 'bytes')
+
+    classes = [('legacy', LegacyEvent)] + \
+        [(n, load_script(n).Event) for n in SCRIPTS]
+
+    for name, cls in classes:
+        assert cls.ARGS == LegacyEvent.ARGS
+        print '  {:<16} {:>12d} {:>8d}'.format(name, int(rate(cls, count)),
+                                               size(cls))
+
+if __name__ == '__main__':
+    main()
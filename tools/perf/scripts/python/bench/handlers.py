@@ -0,0 +1,94 @@
+
+# Benchmark of the per-event handlers generated at trace_begin against
+# the trace_unhandled fallback, as perf calls them
+#
+# usage: python bench/handlers.py [count]
+
+import imp
+import os
+import random
+import sys
+import time
+import types
+
+# The scripts import Util from the perf installation; a stub is
+# enough to load them outside of perf
+if 'Util' not in sys.modules:
+    Util = types.ModuleType('Util')
+    Util.nsecs = lambda secs, nsecs: secs * 1000000000 + nsecs
+    sys.modules['Util'] = Util
+os.environ.setdefault('PERF_EXEC_PATH', '')
+
+SCRIPTS = (('latency', ['events=sched:sched_wakeup,sched:sched_switch']),
+           ('count_between', ['events=irq:entry,irq:raise,irq:exit']),
+           ('timeslot', ['events=sched:sched_wakeup,sched:sched_switch']))
+# Some unconfigured events, and the payload fields perf hands over
+NOISE = ['kmem__kmalloc', 'kmem__kfree', 'syscalls__sys_enter_read']
+PAYLOAD = (('prev_comm', 'kworker/0:1'), ('prev_pid', 42),
+           ('prev_prio', 120), ('prev_state', 1), ('next_comm', 'bash'),
+           ('next_pid', 4242), ('next_prio', 120))
+
+# --- Events generation part ---
+
+def generate(names, count):
+    # (name, cpu, secs, nsecs, pid, comm) tuples, half of them noise
+    rand = random.Random(0)
+    names = names + NOISE[:len(names)]
+    nsecs = 0
+    events = []
+    for i in xrange(count):
+        nsecs += rand.randrange(1, 2000)
+        events.append((rand.choice(names), rand.randrange(4),
+                       nsecs / 1000000000, nsecs % 1000000000,
+                       rand.randrange(1, 100), 'task'))
+    return events
+
+# --- Measurement part ---
+
+def load_script(name, options):
+    path = os.path.join(os.path.dirname(__file__), '..', name + '.py')
+    sys.argv = [path] + options
+    script = imp.load_source('bench_' + name, path)
+    script.trace_begin()
+    return script
+
+def dispatch(script, events, native):
+    # Perf looks a handler up by name, and otherwise builds the fields
+    # dict (payload included) for trace_unhandled
+    unhandled = script.trace_unhandled
+    handlers = {}
+    start = time.time()
+    for name, cpu, secs, nsecs, pid, comm in events:
+        handler = handlers.get(name)
+        if handler is None:
+            handler = handlers[name] = getattr(script, name, False) \
+                if native else False
+        if handler:
+            handler(name, None, cpu, secs, nsecs, pid, comm, None,
+                    *[v for k, v in PAYLOAD])
+        else:
+            fields = dict(PAYLOAD)
+            fields.update(common_cpu = cpu, common_s = secs,
+                          common_ns = nsecs, common_pid = pid,
+                          common_comm = comm, common_callchain = None)
+            unhandled(name, None, fields)
+    return time.time() - start
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    print '# === Event dispatch ({} events, half unconfigured) ==='.format(
+        count)
+    print '# {:<16} {:>12} {:>12} {:>8}'.format('script', 'unhandled/s',
+                                                'handlers/s', 'speedup')
+
+    for name, options in SCRIPTS:
+        names = [n.replace(':', '__') for n in options[0][7:].split(',')]
+        events = generate(names, count)
+        rates = [count / dispatch(load_script(name, options), events, native)
+                 for native in (False, True)]
+        print '  {:<16} {:>12d} {:>12d} {:>7.2f}x'.format(
+            name, int(rates[0]), int(rates[1]), rates[1] / rates[0])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+
+# Benchmark of the three scripts over synthetic traces, checked
+# against brute-force references
+#
+# usage: python bench/scripts.py [--count N] [--cpus N] [--rate N]
+#                                [--jitter NS] [--chain N] [--noise R]
+
+import argparse
+import imp
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import types
+
+import synthetic
+
+# The scripts import Util from the perf installation; a stub is
+# enough to load them outside of perf
+if 'Util' not in sys.modules:
+    Util = types.ModuleType('Util')
+    Util.nsecs = lambda secs, nsecs: secs * 1000000000 + nsecs
+    sys.modules['Util'] = Util
+os.environ.setdefault('PERF_EXEC_PATH', '')
+
+SLOT = 100000
+WINDOW = 1000000
+
+# --- References part ---
+
+def streams(events, names):
+    # The configured events of each cpu, in timestamp order (the sort
+    # is stable: simultaneous events keep their arrival order)
+    result = {}
+    for name, cpu, nsecs, pid, comm in events:
+        if name in names:
+            result.setdefault(cpu, []).append((nsecs, name))
+    for stream in result.values():
+        stream.sort(key = lambda e: e[0])
+    return result
+
+def reference_latency(events, chain):
+    # {(cpu, latency index): [latencies]}, the last index being the
+    # total, from cycles closed when the chain order goes backwards
+    names = [n.replace(':', '__') for n in chain]
+    result = {}
+
+    def close(cpu, times):
+        pairs = zip(range(len(names) - 1), times, times[1:])
+        pairs.append((len(names) - 1, times[0], times[-1]))
+        for index, start, end in pairs:
+            if start is not None and end is not None:
+                result.setdefault((cpu, index), []).append(end - start)
+
+    for cpu, stream in streams(events, names).iteritems():
+        times = [None] * len(names)
+        current = 0
+        for nsecs, name in stream:
+            index = names.index(name)
+            if index < current:
+                close(cpu, times)
+                times = [None] * len(names)
+            times[index] = nsecs
+            current = index + 1
+            if current == len(names):
+                close(cpu, times)
+                times = [None] * len(names)
+                current = 0
+        close(cpu, times)
+    return result
+
+def reference_count(events, chain):
+    # {(cpu, counted index): [counts]}, one count per start...stop
+    # window of each cpu
+    names = [n.replace(':', '__') for n in chain]
+    start, stop, counted = names[0], names[-1], names[1:-1]
+    result = {}
+
+    for cpu, stream in streams(events, names).iteritems():
+        counts = None
+        for nsecs, name in stream:
+            if name == start:
+                counts = [0] * len(counted)
+            elif counts is None:
+                continue
+            elif name == stop:
+                for index, count in enumerate(counts):
+                    result.setdefault((cpu, index), []).append(count)
+                counts = None
+            else:
+                counts[counted.index(name)] += 1
+    return result
+
+def reference_timeslot(events, chain):
+    # {(slot, cpu, name index): count}
+    names = [n.replace(':', '__') for n in chain]
+    result = {}
+    for name, cpu, nsecs, pid, comm in events:
+        if name in names:
+            key = (nsecs / SLOT, cpu, names.index(name))
+            result[key] = result.get(key, 0) + 1
+    return result
+
+# --- Checks part ---
+
+def check_statistics(events, reference, names):
+    # The per cpu statistics must match the reference values
+    cpus = set([cpu for cpu, index in reference])
+    for cpu in cpus:
+        for index, name in enumerate(names):
+            values = reference.get((cpu, index), [])
+            stats = events.get_statistics(cpu, name)
+            expected = (len(values), sum(values),
+                        min(values) if values else None,
+                        max(values) if values else None)
+            got = (stats.count, stats.sum,
+                   stats.min if stats.count else None,
+                   stats.max if stats.count else None)
+            if got != expected:
+                return 'cpu {} {}: {} != {}'.format(cpu, name, got, expected)
+    return None
+
+def check_latency(script, events, chain):
+    return check_statistics(script.events, reference_latency(events, chain),
+                            script.events.get_names())
+
+def check_pairs(script, events, chain):
+    # The NumPy two-event path must match the reference and, down to the
+    # quantiles and histograms, the scalar path
+    error = check_latency(script, events, chain)
+    if error is not None:
+        return error
+
+    # The shared modules only use NumPy when PerfExtra finds it; the
+    # scalar run is a module of its own, the NumPy results are kept
+    numpy_events = script.events
+    scalar = load_script('latency', sys.argv[1:])
+    if scalar is script:
+        return 'the scalar run would replace the NumPy one'
+    import PerfExtra
+    found = PerfExtra.numpy()
+    PerfExtra._numpy = None
+    try:
+        scalar.trace_begin()
+        drive_batches(scalar, events)
+        scalar.events.flush()
+    finally:
+        PerfExtra._numpy = found
+
+    if numpy_events.get_keys() != scalar.events.get_keys():
+        return 'scalar keys differ'
+    for key in numpy_events.get_keys():
+        for name in numpy_events.get_names():
+            got = numpy_events.get_statistics(key, name)
+            expected = scalar.events.get_statistics(key, name)
+            if (got.count, got.sum, got.min, got.max,
+                got.quantiles.buckets) != \
+                (expected.count, expected.sum, expected.min, expected.max,
+                 expected.quantiles.buckets):
+                return 'key {} {}: scalar statistics differ'.format(key, name)
+            if list(numpy_events.get_histogram(key, name).get_values()) != \
+                    list(scalar.events.get_histogram(key, name).get_values()):
+                return 'key {} {}: scalar histogram differs'.format(key, name)
+    return None
+
+def check_count(script, events, chain):
+    return check_statistics(script.events, reference_count(events, chain),
+                            script.events.get_names())
+
+def check_timeslot(script, events, chain):
+    timeslots = script.timeslots
+    reference = reference_timeslot(events, chain)
+    for (index, cpu, name_index), count in reference.iteritems():
+        got = timeslots[index][timeslots.cpu_index(cpu), name_index]
+        if got != count:
+            return 'slot {} cpu {} e{}: {} != {}'.format(index, cpu,
+                                                         name_index, got,
+                                                         count)
+    total = sum([sum(timeslots[i].get_total()) for i in timeslots.keys()])
+    if total != sum(reference.values()):
+        return 'total {} != {}'.format(total, sum(reference.values()))
+    return None
+
+# --- Measurement part ---
+
+# (label, script, check, blocks of events, chain length)
+SCRIPTS = (('latency', 'latency', check_latency, False, None),
+           ('count_between', 'count_between', check_count, False, None),
+           ('timeslot', 'timeslot', check_timeslot, False, None),
+           ('latency pairs', 'latency', check_pairs, True, 2))
+
+def load_script(name, options):
+    path = os.path.join(os.path.dirname(__file__), '..', name + '.py')
+    sys.argv = [path] + options
+    # A new module each time: imp.load_source() would otherwise run the
+    # script again in the one already loaded, replacing its globals
+    sys.modules.pop('bench_' + name, None)
+    return imp.load_source('bench_' + name, path)
+
+def drive(script, events):
+    # Like perf: the event handler of the script if any, otherwise
+    # trace_unhandled with the fields dict
+    handlers = {}
+    for name, cpu, nsecs, pid, comm in events:
+        handler = handlers.get(name)
+        if handler is None:
+            handler = handlers[name] = getattr(script, name, False)
+        if handler:
+            handler(name, None, cpu, 0, nsecs, pid, comm, None)
+        else:
+            script.trace_unhandled(name, None,
+                                   {'common_cpu': cpu, 'common_s': 0,
+                                    'common_ns': nsecs, 'common_pid': pid,
+                                    'common_comm': comm})
+
+def drive_batches(script, events, size = 65536):
+    # Like replay.py: blocks of columns, with the script name ids
+    ids = script.get_batch_ids()
+    for start in xrange(0, len(events), size):
+        names, cpus, times, pids, comms = zip(*events[start:start + size])
+        script.trace_batch(([ids.get(n, -1) for n in names], cpus, times,
+                            pids, comms))
+
+def measure(args):
+    # Run in a child process so that the peak RSS is the script one
+    name, check, batch, parameters = args
+    chain = synthetic.chain_names(parameters['chain'])
+    events = synthetic.generate(**parameters)
+
+    options = ['events=' + ','.join(chain), 'window={}'.format(WINDOW)]
+    if name == 'timeslot':
+        options.append('slot={}'.format(SLOT))
+    if batch:
+        options += ['histo=log', 'percentiles']
+    script = load_script(name, options)
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        script.trace_begin()
+        (drive_batches if batch else drive)(script, events)
+        script.trace_end()
+        elapsed = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return len(events) / elapsed, rss, check(script, events, chain)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark the scripts over synthetic traces')
+    parser.add_argument('--count', type = int, default = 200000)
+    parser.add_argument('--cpus', type = int, default = 4)
+    parser.add_argument('--rate', type = int, default = 1000000,
+                        help = 'events per second on each cpu')
+    parser.add_argument('--jitter', type = int, default = 100000,
+                        help = 'maximum arrival delay (ns)')
+    parser.add_argument('--chain', type = int, default = 3,
+                        help = 'number of configured events')
+    parser.add_argument('--noise', type = float, default = 0.5,
+                        help = 'ratio of unconfigured events')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+    if args.jitter >= WINDOW:
+        parser.error('the jitter must stay within the reorder window')
+    if args.chain < 3:
+        parser.error('count_between needs three events at least')
+
+    parameters = dict(vars(args))
+    print '# === Scripts: {count} events, {cpus} cpus, {rate} ev/s/cpu, ' \
+        'jitter {jitter}ns, chain {chain}, noise {noise} ==='.format(
+            **parameters)
+    print '# {:<16} {:>12} {:>10} {}'.format('script', 'events/s',
+                                             'peak RSS', 'check')
+
+    failures = 0
+    for label, name, check, batch, chain in SCRIPTS:
+        # A fresh process per script (see measure())
+        pool = multiprocessing.Pool(1)
+        rate, rss, error = pool.apply(measure, ((name, check, batch,
+            dict(parameters, chain = chain or parameters['chain'])),))
+        pool.close()
+        pool.join()
+
+        failures += error is not None
+        print '  {:<16} {:>12d} {:>8d}kB {}'.format(label, int(rate), rss,
+                                                   error or 'ok')
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+
+# Synthetic event streams for the benchmarks
+#
+# usage: python bench/synthetic.py [count] (prints the generated events)
+
+import random
+import sys
+
+SUBSYSTEM = 'bench'
+NOISE = SUBSYSTEM + ':noise'
+
+def chain_names(length):
+    # The configured events, as given to the scripts options
+    return ['{}:e{}'.format(SUBSYSTEM, i) for i in xrange(length)]
+
+def generate(count, cpus = 4, rate = 1000000, jitter = 100000, chain = 3,
+             noise = 0.5, seed = 0):
+    # Returns count (name, cpu, nsecs, pid, comm) events in arrival
+    # order; the names are the perf handler ones (sys__event)
+    #
+    # - rate: events per second on each cpu
+    # - jitter: maximum delay (ns) between an event timestamp and its
+    #   arrival, so that events come out of order
+    # - chain: number of events of the configured chain; each cpu
+    #   mostly follows the chain, sometimes jumping anywhere in it
+    # - noise: ratio of unconfigured events
+    rand = random.Random(seed)
+    names = [n.replace(':', '__') for n in chain_names(chain)]
+    noise_name = NOISE.replace(':', '__')
+    gap = max(2, 2 * 1000000000 / rate)
+
+    events = []
+    nsecs = [0] * cpus
+    positions = [0] * cpus
+    for i in xrange(count):
+        cpu = rand.randrange(cpus)
+        nsecs[cpu] += rand.randrange(1, gap)
+
+        if rand.random() < noise:
+            name = noise_name
+        else:
+            if rand.random() < 0.1:
+                positions[cpu] = rand.randrange(chain)
+            name = names[positions[cpu]]
+            positions[cpu] = (positions[cpu] + 1) % chain
+
+        pid = 1000 + cpu * 10 + rand.randrange(4)
+        arrival = nsecs[cpu] + rand.randrange(jitter + 1)
+        events.append((arrival, i, (name, cpu, nsecs[cpu], pid,
+                                    'task-{}'.format(pid))))
+
+    # Sorting by arrival time (then generation order) shuffles the
+    # timestamps within the jitter
+    events.sort()
+    return [e[2] for e in events]
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    for event in generate(count):
+        print '{:<12} {:3d} {:15d} {:6d} {}'.format(*event)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+
+# Throughput of pipe.py over the perf script text of synthetic traces,
+# checked against the reports of the same events given directly
+#
+# usage: python bench/text.py [--count N] [--chain N] [--noise R]
+
+import argparse
+import os
+import StringIO
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import pipe
+import scripts
+import synthetic
+
+def to_text(events):
+    # The default perf script fields, times in nsecs (--ns)
+    lines = []
+    for name, cpu, nsecs, pid, comm in events:
+        lines.append('{:>16} {:>6} [{:03d}] {:>5d}.{:09d}: {}: '
+                     'prev_pid={}\n'.format(comm, pid, cpu,
+                                            nsecs / 1000000000,
+                                            nsecs % 1000000000,
+                                            name.replace('__', ':'), pid))
+    return ''.join(lines)
+
+def report(name, options, feed, *args):
+    # The report of a fresh script fed by feed(script, *args), and the
+    # feeding time (the module is loaded anew: the handlers of a previous
+    # run would stay in its globals)
+    sys.modules.pop('bench_' + name, None)
+    script = scripts.load_script(name, options)
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        start = time.time()
+        script.trace_begin()
+        feed(script, *args)
+        elapsed = time.time() - start
+        script.trace_end()
+        return sys.stdout.getvalue(), elapsed
+    finally:
+        sys.stdout = stdout
+
+class Sink:
+    # A script taking the blocks of events without processing them: the
+    # throughput of the parsing alone
+    def __init__(self, names):
+        self.config = argparse.Namespace(events = names)
+        self.count = 0
+
+    def get_batch_ids(self):
+        return dict((n.replace(':', '__'), i)
+                    for i, n in enumerate(self.config.events))
+
+    def trace_batch(self, columns):
+        self.count += len(columns[0])
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark pipe.py over synthetic traces')
+    parser.add_argument('--count', type = int, default = 200000)
+    parser.add_argument('--chain', type = int, default = 3,
+                        help = 'number of configured events')
+    parser.add_argument('--noise', type = float, default = 0.5,
+                        help = 'ratio of unconfigured events')
+    args = parser.parse_args()
+    if args.chain < 3:
+        parser.error('count_between needs three events at least')
+
+    events = synthetic.generate(args.count, chain = args.chain,
+                                noise = args.noise)
+    text = to_text(events)
+    chain = synthetic.chain_names(args.chain)
+    common = ['events=' + ','.join(chain),
+              'window={}'.format(scripts.WINDOW)]
+
+    print '# === Text: {} events ({} MB), chain {}, noise {} ==='.format(
+        len(events), len(text) / 1000000, args.chain, args.noise)
+    print '# {:<20} {:>10} {}'.format('script', 'MB/s', 'check')
+
+    # (label, script, options, reference options): the filter sends
+    # the events through trace_unhandled with their payload fields,
+    # which the reference only has as common ones
+    slot = ['slot={}'.format(scripts.SLOT)]
+    runs = (('latency', 'latency', [], []),
+            ('count_between', 'count_between', [], []),
+            ('timeslot', 'timeslot', slot, slot),
+            ('latency filter', 'latency', ['filter=prev_pid>0'],
+             ['filter=common_pid>0']))
+    failures = 0
+    # The NumPy import, once per process, is not part of the throughput
+    pipe.PerfExtra.numpy()
+    sink = Sink(chain)
+    start = time.time()
+    pipe.feed(sink, StringIO.StringIO(text))
+    elapsed = time.time() - start
+    expected = len([e for e in events if e[0].replace('__', ':') in chain])
+    error = None if sink.count == expected else 'events count mismatch'
+    failures += error is not None
+    print '  {:<20} {:>10.1f} {}'.format('parsing only',
+                                         len(text) / elapsed / 1e6,
+                                         error or 'ok')
+
+    for label, name, options, reference in runs:
+        expected, _ = report(name, common + reference, scripts.drive, events)
+        result, elapsed = report(name, common + options, pipe.feed,
+                                 StringIO.StringIO(text))
+        error = None if result == expected else 'report mismatch'
+        failures += error is not None
+        print '  {:<20} {:>10.1f} {}'.format(label, len(text) / elapsed / 1e6,
+                                             error or 'ok')
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
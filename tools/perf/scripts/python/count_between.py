@@ -2,124 +2,67 @@
 import os
 import sys
 
-sys.path.append(os.environ['PERF_EXEC_PATH'] + \
-	'/scripts/python/Perf-Trace-Util/lib/Perf/Trace')
+# Outside of perf (see replay.py), a stub Util module is provided; the
+# shared modules are next to perf's ones, under the scripts directory
+if 'PERF_EXEC_PATH' in os.environ:
+    sys.path.append(os.environ['PERF_EXEC_PATH'] + \
+        '/scripts/python/Perf-Trace-Util/lib/Perf/Trace')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'Perf-Trace-Util', 'lib', 'Perf', 'Trace'))
 
 import Util 
 
-# --- Events management part ---
-
-class Event:
-    ARGS = ('name', 'context', 'cpu', 'nsecs', 'pid', 'comm')
-
-    def __init__(self, *args, **keywords):
-        # Basic checking
-        assert len(args) == len(Event.ARGS)
-
-        # Set the mandatory arguments...
-        for i, arg in enumerate(Event.ARGS):
-            setattr(self, arg, args[i])
+import PerfExtra.events
+import PerfExtra.options
 
-        # ...and the optional ones (one never knows)
-        for key, value in keywords.iteritems():
-            setattr(self, key, value)
+# The modules of the options (fields, output, live, profile, sampling
+# and snapshot) are only imported when the options are set
+from PerfExtra.events import Event
+from PerfExtra.handlers import new_handler
 
-class Events:
-    SIZE_THRESHOLD = 1024
-    LEFT_THRESHOLD = 128
+# --- Events management part ---
 
-    def __init__(self, config):
-        self._config = config
-        self._events = {}
+class Events(PerfExtra.events.Events):
+    def __init__(self, config, on_interval = None, raw = None):
+        PerfExtra.events.Events.__init__(self, config, on_interval, raw)
         self._counts = {}
-        self._statistics = {}
-        self._histograms = {} if self._config.histo else None
-
-    def _add_cpu(self, cpu):
-        # ...so, for each cpu, we create a simple events
-        # container...
-        self._events[cpu] = []
 
-        # ...a counts processing instance...
-        self._counts[cpu] = Counts(self._config.events)
+    def _add_key(self, key, reorder = None):
+        # A counts processing instance...
+        self._counts[key] = Counts(self._config.events,
+                                   (self._config.sample, key))
+        if self._names is None:
+            self._names = self._counts[key].names
 
-        # ...a statistics processing instance...
-        self._statistics[cpu] = dict([(n, Statistics()) 
-                                      for n in self._counts[cpu].names])
+        # ...along with the reordering and the results
+        PerfExtra.events.Events._add_key(self, key, reorder)
 
-        # ...and a histogram instance
-        if self._config.histo:
-            self._histograms[cpu] = dict([(n, Histogram(*self._config.histo)) 
-                                          for n in self._counts[cpu].names])
-
-    def _process_counts(self, cpu, events):
-        for event in events:
-            self._counts[cpu].update(event)
-
-        for _name, _counts in self._counts[cpu].getitems().iteritems():
-            _statistics = self._statistics[cpu][_name]
-            for _count in _counts:
-                _statistics.update(_count)
-
-            if self._config.histo:
-                _histogram = self._histograms[cpu][_name]
-                for _count in _counts:
-                    _histogram.update(_count)
-        
-    def append(self, other):
-        cpu = other.cpu
-        # To prevent tricky cpu detection code, cpus are discovered
-        # through the events...
-        if cpu not in self._events:
-            self._add_cpu(cpu)
-
-        self._events[cpu].append(other)
-
-        if len(self._events[cpu]) > Events.SIZE_THRESHOLD:
-            self._events[cpu].sort(lambda a,b: cmp(a.nsecs, b.nsecs))
-            
-            events_subset = self._events[cpu][:-Events.LEFT_THRESHOLD]
-            self._process_counts(cpu, events_subset)
-
-            self._events[cpu] = self._events[cpu][-Events.LEFT_THRESHOLD:]
-
-    def flush(self):
-        for cpu in self._events.keys():
-            self._events[cpu].sort(lambda a,b: cmp(a.nsecs, b.nsecs))
-            self._process_counts(cpu, self._events[cpu])
-            self._events[cpu] = []
-
-    def get_names(self):
-        if len(self._counts) == 0:
-            raise ValueError('No events detected')
-        first_key = self._counts.keys()[0]
-        return self._counts[first_key].names
-                    
-    def get_cpus(self):
-        return self._events.keys() + ['all']
-
-    def get_statistics(self, cpu, name):
-        if cpu == 'all':
-            all_stats = [self._statistics[c][name] for c in self._events.keys()]
-            return reduce(lambda x, y: x + y, all_stats)
-        else:
-            return self._statistics[cpu][name]
+    def _update(self, key, events):
+        self._counts[key].update_many(events)
+        return self._counts[key].getitems().iteritems()
 
-    def get_histogram(self, cpu, name):
-        if cpu == 'all':
-            all_histos = [self._histograms[c][name] 
-                          for c in self._events.keys()]
-            return reduce(lambda x, y: x + y, all_histos)
-        else:
-            return self._histograms[cpu][name]
+    def _drop_key(self, key):
+        del self._counts[key]
 
 # --- Counting part ---
 
 class Counts:
-    def __init__(self, names):
+    START = -1
+    STOP = -2
+
+    def __init__(self, names, sample = (1, None)):
         self._preset_names(names)
         self._preset_values(names)
 
+        # With sampling, 1 in rate cycles of the key is counted: the
+        # choice is made at the start event, by its timestamp (see
+        # PerfExtra/sampling.py), and holds until the stop one
+        self._rate = sample[0]
+        self._seed = None
+        if self._rate > 1:
+            from PerfExtra.sampling import get_seed
+            self._seed = get_seed(sample[1])
+
     def _preset_names(self, names):
         self.edges = [names[0], names[-1]]
         self.names = names[1 : -1]
@@ -128,33 +71,81 @@ class Counts:
         self._names = [n.replace(':', '__') for n in self.names]
 
     def _preset_values(self, names):
-        # Build a map to translate event names to indexes
+        # Build a map to translate event names to indexes; the edges
+        # are given negative indexes (the start edge prevails)
         self._name_to_index = dict((n, i) for i, n in enumerate(self._names))
+        self._name_to_index[self._edges[1]] = Counts.STOP
+        self._name_to_index[self._edges[0]] = Counts.START
 
         self._record_status = False
         self._current_counts = None
         self._all_counts = []
 
     def update(self, event):
-        if event.name == self._edges[0]:
+        # Skip the event if it is not in the list
+        index = self._name_to_index.get(event.name)
+        if index is None:
+            return
+
+        if index == Counts.START:
             # If the current event is the start point, let's start the
-            # counting process
-            self._current_counts = [0 for _ in self.names]
-            self._record_status = True
+            # counting process (unless the cycle is sampled out)
+            self._current_counts = [0] * len(self.names)
+            if self._rate == 1:
+                self._record_status = True
+            else:
+                from PerfExtra.sampling import is_sampled
+                self._record_status = is_sampled(self._rate, self._seed,
+                                                 event.nsecs)
 
-        elif self._record_status and event.name == self._edges[1]:
+        elif not self._record_status:
+            return
+
+        elif index == Counts.STOP:
             # If the current event is the stop point, let's append the
             # results
             self._all_counts.append(self._current_counts)
             self._current_counts = None
             self._record_status = False
 
-        elif self._record_status and event.name in self._name_to_index:
+        else:
             # If the current event is between the edge events, let's
-            # count it            
-            index = self._name_to_index[event.name]
+            # count it
             self._current_counts[index] += 1
 
+    def update_many(self, events):
+        # Same as update(), over a block of events with the state kept
+        # in locals
+        name_to_index = self._name_to_index
+        all_counts = self._all_counts
+        recording = self._record_status
+        counts = self._current_counts
+        width = len(self.names)
+        rate = self._rate
+        seed = self._seed
+        if rate > 1:
+            from PerfExtra.sampling import is_sampled
+
+        for event in events:
+            index = name_to_index.get(event.name)
+            if index is None:
+                continue
+
+            if index == Counts.START:
+                counts = [0] * width
+                recording = rate == 1 or is_sampled(rate, seed, event.nsecs)
+            elif not recording:
+                continue
+            elif index == Counts.STOP:
+                all_counts.append(counts)
+                counts = None
+                recording = False
+            else:
+                counts[index] += 1
+
+        self._record_status = recording
+        self._current_counts = counts
+
     def getitems(self):
         # Here, we return the results and flush them (we restart from
         # scratch)
@@ -163,133 +154,20 @@ class Counts:
 
         # The counts are gathered by counted event...
         all_counts = zip(*all_counts) \
-            if len(all_counts) > 0 else ([] * len(self.names))
+            if len(all_counts) > 0 else ([()] * len(self.names))
 
         # ...and returned into a dict instance
         return dict([(n, all_counts[i]) for i, n in enumerate(self.names)])
 
-# --- Counts analysis part ---
-
-class Statistics:
-    def __init__(self, stats = None):
-        if stats is None:
-            self.min = 1000000000
-            self.max = 0
-            self.sum = 0
-            self.count = 0
-        else:
-            self.min = stats.min
-            self.max = stats.max
-            self.sum = stats.sum
-            self.count = stats.count
-
-    def __iadd__(self, other):
-        if other.min < self.min:
-            self.min = other.min
-        if other.max > self.max:
-            self.max = other.max
-        self.sum += other.sum
-        self.count += other.count
-        return self
-
-    def __add__(self, other):
-        result = Statistics(stats = self)
-        result += other
-        return result
-
-    def update(self, value):
-        if value < self.min:
-            self.min = value
-        if value > self.max:
-            self.max = value
-        self.sum += value
-        self.count += 1
-
-    def get_values(self):
-        result = (0 , 0, 0) if self.count == 0 else \
-            (self.min, self.max, self.sum / self.count)
-        return result
-
-class Histogram:
-    def __init__(self, bucket_size = 10, buckets_count = 20, histo = None):
-        if histo is None:
-            self.step = bucket_size
-            self.count = buckets_count
-            self.buckets = [i for i in xrange(self.count)]
-            self.histo = [0 for i in xrange(self.count)]
-            self.overflow = 0
-            self.total = 0
-        else:
-            self.step = histo.step
-            self.count = histo.count
-            self.buckets = histo.buckets
-            self.histo = histo.histo[:]
-            self.overflow = histo.overflow
-            self.total = histo.total
-
-    def __iadd__(self, other):
-        for i, count in enumerate(other.histo):
-            self.histo[i] += count
-        self.overflow += other.overflow
-        self.total += other.total
-        return self
-
-    def __add__(self, other):
-        result = Histogram(histo = self)
-        result += other
-        return result
-
-    def update(self, value):
-        index = int(value / self.step)
-        if index < self.count:
-            self.histo[index] += 1
-        else:
-            self.overflow += 1
-        self.total += 1
-
-    def get_values(self):
-        return self.histo
-
 # --- Options management part ---
 
-class Options:
-    class Events:
-        NAME = 'events='
-        @staticmethod
-        def check(arg):
-            return arg[:len(Options.Events.NAME)] == Options.Events.NAME
-        def __init__(self, arg):
-            self.config = arg[len(Options.Events.NAME):].split(',')
-
-    class Histo:
-        NAME = 'histo'
-        @staticmethod
-        def check(arg):
-            return arg[:len(Options.Histo.NAME)] == Options.Histo.NAME
-        def __init__(self, arg):
-            bucket = 10
-            count = 20
-            name = Options.Histo.NAME + '='
-            if arg[:len(name)] == name:
-                _arg = arg[len(name):].split(',')
-                if len(_arg) > 0:
-                    bucket = int(_arg[0])
-                if len(_arg) > 1:
-                    count = int(_arg[1])
-
-            self.config = (bucket, count)
+class Options(PerfExtra.options.KeyedOptions):
+    class Histo(PerfExtra.options.KeyedOptions.Histo):
+        BUCKET = 10
+        COUNT = 20
 
     def __init__(self, args):
-        self.events = []
-        self.histo = None
-
-        for arg in args:
-            if Options.Events.check(arg):
-                self.events = Options.Events(arg).config
-            elif Options.Histo.check(arg):
-                self.histo = Options.Histo(arg).config
-            else:
-                raise ValueError('Unsupported options: ' + arg)
+        PerfExtra.options.KeyedOptions.__init__(self, args)
 
         if len(self.events) < 3:
             raise ValueError('Three events are needed at least')
@@ -300,42 +178,104 @@ def print_legend(events):
     names = events.get_names()
 
     print '# === Legend ==='
+    if events._config.sample > 1:
+        print '# Sampling: 1 in {} cycles, counts scaled'.format(
+            events._config.sample)
     legends = ['# E{:02d}: {}'.format(i, n) for i, n in enumerate(names)]
     for legend in legends:
         print legend
     
-def print_stats(events):
+def print_stats(events, delta = False):
     names = events.get_names()
-    cpus = events.get_cpus()
+    keys = events.get_keys()
+    label = events._config.key + 's'
 
     print '# === Statistics: min avg max (ns) ==='
-    tmp = ['{:^23}'.format(c) for c in cpus]
-    print '# cpus: ' + ' | '.join(tmp)
+    tmp = ['{:^23}'.format(c) for c in keys]
+    print '# {}: '.format(label) + ' | '.join(tmp)
 
     for i, name in enumerate(names):
-        values = [events.get_statistics(c, name).get_values() for c in cpus]
+        values = [events.get_statistics(c, name, delta).get_values()
+                  for c in keys]
         tmp = ['{:07d} {:07d} {:07d}'.format(v[0], v[2], v[1]) for v in values]
         line = '{:^6}: '.format('E{:02d}'.format(i)) + ' | '.join(tmp)
         print line
 
-def print_histograms(events):
+def print_percentiles(events, delta = False):
     names = events.get_names()
-    cpus = events.get_cpus()
+    keys = events.get_keys()
+    label = events._config.key + 's'
+    percentiles = events._config.percentiles
+
+    tmp = ['p{:g}'.format(p) for p in percentiles]
+    print '# === Percentiles: {} (ns) ==='.format(' '.join(tmp))
+    key_format = '{:^SIZE}'.replace('SIZE', str(len(percentiles) * 8 - 1))
+    tmp = [key_format.format(c) for c in keys]
+    print '# {}: '.format(label) + ' | '.join(tmp)
+
+    for i, name in enumerate(names):
+        values = [events.get_statistics(c, name, delta)
+                  .get_percentiles(percentiles) for c in keys]
+        tmp = [' '.join(['{:07d}'.format(p) for p in v]) for v in values]
+        line = '{:^6}: '.format('E{:02d}'.format(i)) + ' | '.join(tmp)
+        print line
+
+def print_log_histograms(events, delta = False):
+    names = events.get_names()
+    keys = events.get_keys()
+    label = events._config.key + 's'
+    digits = events._config.histo[1]
+
+    print '# === Histograms: log:{} digits ==='.format(digits)
+
+    for i, name in enumerate(names):
+        tmp = ['{:^4}'.format(c) for c in keys]
+        print ' E{:02d} \ {}: '.format(i, label) + ' | '.join(tmp)
+
+        histograms = [events.get_histogram(c, name, delta) for c in keys]
+        scale = events.get_scale()
+        buckets = histograms[-1].get_buckets()
+        values = [h.get_values() for h in histograms]
+        overflows = [h.overflow * scale for h in histograms]
+        totals = [h.total * scale for h in histograms]
+
+        # Only the non-empty buckets are printed (the last histogram
+        # gathers all the keys)
+        for i, bucket in enumerate(buckets):
+            if values[-1][i] == 0:
+                continue
+            tmp =  ['{:04d}'.format(v[i] * scale) for v in values]
+            line = '{:011d}: '.format(bucket) + ' | '.join(tmp)
+            print line
+
+        tmp =  ['{:04d}'.format(o) for o in overflows]
+        line  = ' overflows : ' + ' | '.join(tmp)
+        print line
+
+        tmp =  ['{:04d}'.format(o) for o in totals]
+        line  = '  totals   : ' + ' | '.join(tmp)
+        print line
+
+def print_histograms(events, delta = False):
+    names = events.get_names()
+    keys = events.get_keys()
+    label = events._config.key + 's'
     bucket, count = events._config.histo
 
     print '# === Histograms: bucket:{} ==='.format(bucket)
 
     for i, name in enumerate(names):
-        tmp = ['{:^4}'.format(c) for c in cpus]
-        print ' E{:02d} \ cpus: '.format(i) + ' | '.join(tmp)
+        tmp = ['{:^4}'.format(c) for c in keys]
+        print ' E{:02d} \ {}: '.format(i, label) + ' | '.join(tmp)
 
-        histograms = [events.get_histogram(c, name) for c in cpus]
+        histograms = [events.get_histogram(c, name, delta) for c in keys]
+        scale = events.get_scale()
         values = [h.get_values() for h in histograms]
-        overflows = [h.overflow for h in histograms]
-        totals = [h.total for h in histograms]
+        overflows = [h.overflow * scale for h in histograms]
+        totals = [h.total * scale for h in histograms]
 
         for i in xrange(count):
-            tmp =  ['{:04d}'.format(v[i]) for v in values]
+            tmp =  ['{:04d}'.format(v[i] * scale) for v in values]
             line = '{:011d}: '.format(i * bucket) + ' | '.join(tmp)
             print line
 
@@ -347,34 +287,198 @@ def print_histograms(events):
         line  = '  totals   : ' + ' | '.join(tmp)
         print line
 
+def print_late(events):
+    keys = events.get_keys()
+    label = events._config.key + 's'
+
+    print '# === Late events: window:{}ns ==='.format(events._config.window)
+    tmp = ['{:^4}'.format(c) for c in keys]
+    print '# {}: '.format(label) + ' | '.join(tmp)
+
+    tmp = ['{:04d}'.format(events.get_late(c)) for c in keys]
+    print ' late : ' + ' | '.join(tmp)
+
+def print_report(events, delta = False):
+    print_stats(events, delta)
+    if config.percentiles:
+        print_percentiles(events, delta)
+    if config.histo and config.histo[0] == 'log':
+        print_log_histograms(events, delta)
+    elif config.histo:
+        print_histograms(events, delta)
+
+def print_interval(events, start, end):
+    # The interval statistics are followed by the cumulative ones
+    print '# === Interval: {}-{}ns ==='.format(start, end)
+    print_legend(events)
+    print_report(events, delta = True)
+    print '# === Cumulative: up to {}ns ==='.format(end)
+    print_report(events)
+    # The live reports go through pipes
+    sys.stdout.flush()
+
+def print_profile(events, profile):
+    from PerfExtra.profile import Profile, print_profile_stages
+    print '# === Profile: 1 in {} per-event calls timed ==='.format(
+        Profile.SAMPLING)
+    late = events.get_late('all')
+    print_profile_stages(profile, ('unhandled', 'handlers', 'process',
+                                   'report'),
+                         ('unhandled', 'handlers', 'report'))
+    outside = profile.get_calls('outside')
+    print ' outside   : {:010d} (out of start= and stop=)'.format(outside)
+    print ' dropped   : {:010d} (unconfigured or filtered)'.format(
+        profile.get_calls('unhandled') + profile.get_calls('handlers') -
+        profile.sorted - late - outside)
+    print ' late      : {:010d}'.format(late)
+    print ' sorted    : {:010d} ({} batches)'.format(
+        profile.sorted, profile.get_calls('process'))
+
+    keys = sorted(profile.peaks)
+    tmp = ['{:^6}'.format(k) for k in keys]
+    print '# {}: '.format(events._config.key + 's') + ' | '.join(tmp)
+    tmp = ['{:06d}'.format(profile.peaks[k]) for k in keys]
+    print ' peak buffer : ' + ' | '.join(tmp)
+
 # --- Perf related part ---
 
+cache = None
 config = None
+profile = None
 events = None
 
+# The predicate compiled from the options
+accept = None
+
+# The trace time bounds, with the blocks selection (the cycles are
+# sampled by the counts themselves)
+start = 0
+stop = float('inf')
+select = None
+
 def trace_unhandled(event_name, context, fields):
-    args = (event_name, 
-            context,
-            fields['common_cpu'],
-            Util.nsecs(fields['common_s'], fields['common_ns']),
-            fields['common_pid'], fields['common_comm'])
-    event = Event(*args)
+    # The cache keeps every event, whatever the configuration
+    if cache is not None:
+        cache.append(event_name, fields['common_cpu'],
+                     Util.nsecs(fields['common_s'], fields['common_ns']),
+                     fields['common_pid'], fields['common_comm'])
+
+    if event_name not in events.ids:
+        return
+
+    # Out of bounds and filtered out events are dropped before any
+    # processing
+    nsecs = Util.nsecs(fields['common_s'], fields['common_ns'])
+    if not start <= nsecs < stop:
+        if profile is not None:
+            profile.stats('outside')[0] += 1
+        return
+    if accept is not None and not accept(fields):
+        return
+
+    event = Event(event_name,
+                  context,
+                  fields['common_cpu'],
+                  nsecs,
+                  fields['common_pid'], fields['common_comm'])
     events.append(event)
 
+
+def get_batch_ids():
+    # The front-ends (see replay.py) may push blocks of events through
+    # trace_batch() with these name ids, unless every event must go
+    # through the handlers (cache, fields or profiling)
+    if cache or accept or profile:
+        return None
+    return events.ids
+
+def trace_batch(columns):
+    if select is not None:
+        columns = select(columns)
+        if columns is None:
+            return
+    events.append_many(columns)
+
 def trace_begin():
     # Parse the script-specific options
     global config
     config = Options(sys.argv[1:])
 
+    global cache
+    if config.cache:
+        from PerfExtra.output import Cache
+        cache = Cache(config.cache)
+
+    # Compile the fields filters, once for all events
+    global accept
+    if config.filters:
+        from PerfExtra.fields import compile_filter
+        accept = compile_filter(config.filters)
+
+    global start, stop, select
+    start, stop = config.start, config.stop
+    if start > 0 or stop < float('inf'):
+        from PerfExtra.sampling import new_selector
+        select = new_selector(start, stop)
+
     # Instanciate the global events holder
     global events
-    events = Events(config)
+    raw = None
+    if config.raw:
+        from PerfExtra.output import NpyWriter
+        raw = NpyWriter(config.output + '.raw.npy', 3)
+    events = Events(config, print_interval, raw)
+    if config.live:
+        from PerfExtra.live import catch_signals
+        catch_signals(events.clock)
+
+    # The profiled stages are wrapped (only then, to leave the normal
+    # path untouched)
+    global profile
+    if config.profile:
+        from PerfExtra.profile import Profile
+        profile = Profile()
+        def peak(key, batch):
+            profile.sorted += len(batch)
+            profile.peak(key, len(events._events[key]))
+        events._process = profile.time('process', events._process,
+                                       probe = peak)
+        globals()['trace_unhandled'] = profile.time(
+            'unhandled', trace_unhandled, Profile.SAMPLING)
+        globals()['print_report'] = profile.time('report', print_report)
+
+    # The configured events get their own handler, unless the cache or
+    # the fields filtering need every fields dict
+    if not (cache or accept):
+        for name in events.ids:
+            stats = profile.stats('handlers') if profile else None
+            outside = profile.stats('outside') if profile else None
+            globals()[name] = new_handler(name, events.append, stats,
+                                          start, stop, outside = outside)
 
 def trace_end():
+    if cache is not None:
+        cache.close()
+
     events.flush()
     # Print the results (according to the configuration)
     print_legend(events)
-    print_stats(events)
-    if config.histo:
-        print_histograms(events)
+    print_report(events)
+    print_late(events)
+
+    # Export the results (and complete the raw values, then save the
+    # snapshot)
+    if config.output:
+        from PerfExtra.output import export_histograms, export_stats
+        export_stats(events, config.output)
+        if config.histo:
+            export_histograms(events, config.output)
+    if config.raw:
+        events._raw.close()
+    if config.snapshot:
+        from PerfExtra.snapshot import save
+        save(config.snapshot, os.path.basename(__file__), sys.argv[1:], events)
+
+    if profile is not None:
+        print_profile(events, profile)
 
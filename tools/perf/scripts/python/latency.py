@@ -2,134 +2,232 @@
 import os
 import sys
 
-sys.path.append(os.environ['PERF_EXEC_PATH'] + \
-	'/scripts/python/Perf-Trace-Util/lib/Perf/Trace')
+# Outside of perf (see replay.py), a stub Util module is provided; the
+# shared modules are next to perf's ones, under the scripts directory
+if 'PERF_EXEC_PATH' in os.environ:
+    sys.path.append(os.environ['PERF_EXEC_PATH'] + \
+        '/scripts/python/Perf-Trace-Util/lib/Perf/Trace')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'Perf-Trace-Util', 'lib', 'Perf', 'Trace'))
 
-import Util 
-
-# --- Events management part ---
+import collections
 
-class Event:
-    ARGS = ('name', 'context', 'cpu', 'nsecs', 'pid', 'comm')
-
-    def __init__(self, *args, **keywords):
-        # Basic checking
-        assert len(args) == len(Event.ARGS)
-
-        # Set the mandatory arguments...
-        for i, arg in enumerate(Event.ARGS):
-            setattr(self, arg, args[i])
+import Util 
 
-        # ...and the optional ones (one never knows)
-        for key, value in keywords.iteritems():
-            setattr(self, key, value)
+import PerfExtra
+import PerfExtra.events
+import PerfExtra.options
 
+# The modules of the options (fields, output, live, profile, sampling
+# and snapshot) are only imported when the options are set
+from PerfExtra.events import ColumnReorder, Event
+from PerfExtra.handlers import new_handler
 
-class Events:
-    SIZE_THRESHOLD = 1024
-    LEFT_THRESHOLD = 128
+# --- Events management part ---
 
-    def __init__(self, config):
-        self._config = config
-        self._events = {}
+class Events(PerfExtra.events.Events):
+    def __init__(self, config, on_interval = None, raw = None):
+        PerfExtra.events.Events.__init__(self, config, on_interval, raw)
+
+        # Several chains are measured at once: each event name maps to
+        # the chains (state machines) mentioning it
+        self._chains = dict((n, []) for n in self.ids)
+        for i, (label, names) in enumerate(config.chains):
+            for name in set(n.replace(':', '__') for n in names):
+                self._chains[name].append(i)
+
+        # A single two-event chain is computed on NumPy columns when
+        # the events come by blocks (see append_many())
+        self._pairs = config.match is None and len(config.chains) == 1 and \
+            len(config.chains[0][1]) == 2
+        self._chain_indexes = None
         self._latencies = {}
-        self._statistics = {}
-        self._histograms = {} if self._config.histo else None
-
-    def _add_cpu(self, cpu):
-        # ...so, for each cpu, we create a simple events
-        # container...
-        self._events[cpu] = []
-
-        # ...a latencies processing instance...
-        self._latencies[cpu] = Latencies(self._config.events, 
-                                         self._config.limit)
-
-        # ...a statistics processing instance...
-        self._statistics[cpu] = dict([(n, Statistics()) 
-                                      for n in self._latencies[cpu].names])
-
-        # ...and a histogram instance
-        if self._config.histo:
-            self._histograms[cpu] = dict([(n, Histogram(*self._config.histo)) 
-                                          for n in self._latencies[cpu].names])
-
-    def _process_latencies(self, cpu, events):
-        for event in events:
-            self._latencies[cpu].update(event)
-
-        for _name, _latencies in self._latencies[cpu].iteritems():
-            _statistics = self._statistics[cpu][_name]
-            for _latency in _latencies:
-                _statistics.update(_latency)
-
-            if self._config.histo:
-                _histogram = self._histograms[cpu][_name]
-                for _latency in _latencies:
-                    _histogram.update(_latency)
-        
-    def append(self, other):
-        cpu = other.cpu
-        # To prevent tricky cpu detection code, cpus are discovered
-        # through the events...
-        if cpu not in self._events:
-            self._add_cpu(cpu)
-
-        self._events[cpu].append(other)
-
-        if len(self._events[cpu]) > Events.SIZE_THRESHOLD:
-            self._events[cpu].sort(lambda a,b: cmp(a.nsecs, b.nsecs))
-            
-            events_subset = self._events[cpu][:-Events.LEFT_THRESHOLD]
-            self._process_latencies(cpu, events_subset)
-
-            self._events[cpu] = self._events[cpu][-Events.LEFT_THRESHOLD:]
-
-    def flush(self):
-        for cpu in self._events.keys():
-            self._events[cpu].sort(lambda a,b: cmp(a.nsecs, b.nsecs))
-            self._process_latencies(cpu, self._events[cpu])
-            self._latencies[cpu].flush()
-            self._events[cpu] = []
-
-    def get_names(self):
-        if len(self._latencies) == 0:
-            raise ValueError('No events detected')
-        first_key = self._latencies.keys()[0]
-        return self._latencies[first_key].names
-                    
-    def get_cpus(self):
-        return self._events.keys() + ['all']
-
-    def get_statistics(self, cpu, name):
-        if cpu == 'all':
-            all_stats = [self._statistics[c][name] for c in self._events.keys()]
-            return reduce(lambda x, y: x + y, all_stats)
+        self._evicted_orphans = [[0, 0] for c in config.chains]
+
+    def _add_key(self, key, reorder = None):
+        # A latencies processing instance per chain...
+        self._latencies[key] = [self._new_latencies(key, names, label)
+                                for label, names in self._config.chains]
+        if self._names is None:
+            self._names = sum([l.names for l in self._latencies[key]], [])
+
+        # ...along with the reordering and the results
+        PerfExtra.events.Events._add_key(self, key, reorder)
+
+    def _new_latencies(self, key, names, label):
+        match = self._config.match
+        sample = (self._config.sample, key)
+        if self._pairs:
+            return PairLatencies(names, self._config.limit, label, sample)
+        if match is None:
+            return Latencies(names, self._config.limit, label, sample)
+
+        # The overlapping cycles are matched in FIFO order, by an event
+        # attribute or by a tracepoint field (kept as the event tag)
+        if match != MatchedLatencies.FIFO:
+            match = Options.Key.ATTRIBUTES.get(match, 'tag')
+        return MatchedLatencies(names, self._config.limit, label, sample,
+                                match, self._config.inflight)
+
+    def _update(self, key, events):
+        chains = self._chains
+        latencies = self._latencies[key]
+        if isinstance(events, tuple):
+            # The (chain indexes, timestamps) columns of a ColumnReorder
+            latencies[0].update_columns(*events)
+        elif len(latencies) == 1:
+            latencies[0].update_many(events)
         else:
-            return self._statistics[cpu][name]
-
-    def get_histogram(self, cpu, name):
-        if cpu == 'all':
-            all_histos = [self._histograms[c][name] 
-                          for c in self._events.keys()]
-            return reduce(lambda x, y: x + y, all_histos)
+            for event in events:
+                for chain in chains[event.name]:
+                    latencies[chain].update(event)
+        return self._iteritems(latencies)
+
+    @staticmethod
+    def _iteritems(latencies):
+        for chain in latencies:
+            for item in chain.iteritems():
+                yield item
+
+    def _drop_key(self, key):
+        self._add_orphans(self._evicted_orphans, self._latencies.pop(key))
+
+    def append_many(self, columns):
+        # The intervals, idle keys and clock need the per-event path
+        config = self._config
+        if self._pairs and PerfExtra.numpy() is not None and \
+                not (config.interval or config.idle or config.live):
+            self._append_columns(columns)
+            return
+        PerfExtra.events.Events.append_many(self, columns)
+
+    def _append_columns(self, columns):
+        numpy = PerfExtra.numpy()
+        if self._chain_indexes is None:
+            # The name ids translated to chain indexes (start 0, end 1)
+            names = [n.replace(':', '__') for n in self._config.chains[0][1]]
+            to_index = dict((n, i) for i, n in enumerate(names))
+            self._chain_indexes = numpy.array([to_index[n]
+                                               for n in self._id_names],
+                                              dtype = numpy.int8)
+
+        # The configured events are grouped by key with a stable sort
+        name_ids = numpy.asarray(columns[0], dtype = numpy.int64)
+        configured = numpy.flatnonzero(name_ids >= 0)
+        if not len(configured):
+            return
+        if self._key == 'comm':
+            keys = numpy.asarray(columns[4])
+        else:
+            keys = numpy.asarray(columns[1 if self._key == 'cpu' else 3],
+                                 dtype = numpy.int64)
+        keys = keys[configured]
+        times = numpy.asarray(columns[2], dtype = numpy.int64)[configured]
+        indexes = self._chain_indexes[name_ids[configured]]
+
+        order = numpy.argsort(keys, kind = 'mergesort')
+        keys = keys[order]
+        bounds = numpy.flatnonzero(keys[1:] != keys[:-1]) + 1
+        starts = [0] + bounds.tolist()
+        ends = bounds.tolist() + [len(keys)]
+
+        for start, end in zip(starts, ends):
+            key = keys[start].item()
+            if key not in self._events:
+                if len(self._events) >= self._config.lru:
+                    self._evict_lru()
+                self._add_key(key, ColumnReorder)
+
+            block = order[start:end]
+            ready = self._events[key].push_many(indexes[block], times[block])
+            self._process(key, ready)
+
+    def _flush_key(self, key):
+        PerfExtra.events.Events._flush_key(self, key)
+        # The latencies of the last (partial) cycles are processed too
+        for chain in self._latencies[key]:
+            chain.flush()
+        self._process(key, [])
+
+    def merge(self, other):
+        PerfExtra.events.Events.merge(self, other)
+        for key, latencies in other._latencies.iteritems():
+            self._add_orphans(self.get_orphans(key), latencies)
+        self._add_orphans(self._evicted_orphans, other._evicted_orphans)
+
+    def get_state(self):
+        state = PerfExtra.events.Events.get_state(self)
+        state['orphans'] = [self.get_orphans(k[0]) for k in state['keys']]
+        return state
+
+    def restore(self, state, host = None):
+        PerfExtra.events.Events.restore(self, state, host)
+        for (key, _, _, _), orphans in zip(state['keys'], state['orphans']):
+            self._add_orphans(self.get_orphans(key if host is None else host),
+                              orphans)
+
+    def get_chains(self):
+        # The latencies names (and their indexes) grouped by chain
+        chains = []
+        index = 0
+        for label, names in self._config.chains:
+            # A chain of n events has n - 1 latencies plus the total
+            count = len(names)
+            names = self.get_names()[index:index + count]
+            chains.append((label, list(enumerate(names, index))))
+            index += count
+        return chains
+
+    @staticmethod
+    def _add_orphans(orphans, others):
+        # Add the per chain orphans counts (or those of the chains)
+        for counts, other in zip(orphans, others):
+            other = getattr(other, 'orphans', other)
+            counts[0] += other[0]
+            counts[1] += other[1]
+
+    def get_orphans(self, key):
+        # The orphans counts of each chain: the cycles evicted or never
+        # completed (starts) and the events no cycle waited for (ends)
+        if key == Events.OTHER:
+            return self._evicted_orphans
+        elif key == 'all':
+            orphans = [[0, 0] for c in self._config.chains]
+            self._add_orphans(orphans, self._evicted_orphans)
+            for latencies in self._latencies.values():
+                self._add_orphans(orphans, latencies)
+            return orphans
         else:
-            return self._histograms[cpu][name]
+            return [l.orphans for l in self._latencies[key]]
 
 # --- Latencies generation part ---
 
 class Latencies:
-    def __init__(self, names, limit):
-        self._preset_names(names)
+    def __init__(self, names, limit, label = None, sample = (1, None)):
+        self._preset_names(names, label)
         self._preset_values(names, limit)
 
-    def _preset_names(self, names):
+        # With sampling, 1 in rate cycles of the key is measured, chosen
+        # by its first timestamp (see PerfExtra/sampling.py)
+        self._rate, self._key = sample
+        self._seed = None
+        if self._rate > 1:
+            from PerfExtra.sampling import get_seed
+            self._seed = get_seed(self._key)
+
+        # A single cycle is in flight: none is ever orphaned (see
+        # MatchedLatencies)
+        self.orphans = [0, 0]
+
+    def _preset_names(self, names, label):
         # Keep the events names
         self._names = [n.replace(':', '__') for n in names]
 
-        # Set the latencies names
+        # Set the latencies names (prefixed by the chain label, if any)
         self.names = [names[i] + ' -> ' + names[i + 1] 
                                 for i in xrange(len(names) - 1)] + ['total']
+        if label is not None:
+            self.names = [label + ': ' + n for n in self.names]
 
     def _preset_values(self, names, limit):
         self._limit = limit
@@ -140,58 +238,100 @@ class Latencies:
         self._latencies_count = len(self.names)
         self._latencies = [[] for i in xrange(self._latencies_count)]
 
+        # The transition table tells, for the current index and the
+        # incoming event index, whether the ongoing cycle must be
+        # closed before recording the event and whether the cycle is
+        # complete once the event is recorded
+        count = self._latencies_count
+        self._transitions = [[(index < current, index + 1 == count)
+                              for index in xrange(count)]
+                             for current in xrange(count)]
+
         self._current_index = 0
-        self._current_nsecs = {}
+        self._current_nsecs = [None] * count
 
-    def _compute_latencies(self):
+    def _compute_latencies(self, times):
         # Here, we try to convert a cycle of timestamps into latencies
 
         # Convenience variables
         latencies_count = self._latencies_count
-        times = self._current_nsecs
-        indexes = times.keys()
+
+        # The sampled out cycles are dropped as a whole
+        if self._rate > 1:
+            from PerfExtra.sampling import is_sampled
+            first = [t for t in times if t is not None]
+            if not first or not is_sampled(self._rate, self._seed, first[0]):
+                return
 
         for i in xrange(latencies_count - 1):
             # If two events occured in the order we expected, we can
             # calculate the related latency
-            if i in indexes and i + 1 in indexes:
+            if times[i] is not None and times[i + 1] is not None:
                 latency = times[i + 1] - times[i]
                 if latency < self._limit:
                     self._latencies[i].append(latency)
 
         # If the first and last events' timestamps, we can get the
         # total latency
-        if 0 in indexes and latencies_count - 1 in indexes:
-            latency = times[latencies_count - 1] - times[0]
+        if times[0] is not None and times[-1] is not None:
+            latency = times[-1] - times[0]
             if latency < self._limit:
                 self._latencies[-1].append(latency)
 
+    def _next_cycle(self):
+        self._compute_latencies(self._current_nsecs)
+        self._current_nsecs = [None] * self._latencies_count
+        self._current_index = 0
+
     def update(self, event):
         # Skip the event if it is not in the list
-        if event.name not in self._name_to_index.keys():
+        index = self._name_to_index.get(event.name)
+        if index is None:
             return
 
-        # Get the index of the event
-        index = self._name_to_index[event.name]
+        restart, complete = self._transitions[self._current_index][index]
+
+        # If the order is not proper, the ongoing cycle is over...
+        if restart:
+            self._next_cycle()
+
+        # ...then, we record the current event's timestamp...
+        self._current_nsecs[index] = event.nsecs
+        self._current_index = index + 1
+
+        # ...and compute the latencies if we reach the end of a cycle
+        if complete:
+            self._next_cycle()
+
+    def update_many(self, events):
+        # Same as update(), over a block of events with the state kept
+        # in locals
+        name_to_index = self._name_to_index
+        transitions = self._transitions
+        count = self._latencies_count
+        current = self._current_index
+        times = self._current_nsecs
+
+        for event in events:
+            index = name_to_index.get(event.name)
+            if index is None:
+                continue
 
-        next_event = False
-        next_cycle = True
+            restart, complete = transitions[current][index]
+            if restart:
+                self._compute_latencies(times)
+                times = [None] * count
 
-        while not next_event:
-            # If the events order is what we expected, we record
-            # the current event's timestamp
-            if index >= self._current_index:
-                self._current_nsecs[index] = event.nsecs
-                self._current_index = index + 1
-                next_event = True
-                next_cycle = False
+            times[index] = event.nsecs
+            current = index + 1
 
-            # If the order is not proper or we reach the end of a
-            # cycle, let's compute the latencies
-            if next_cycle or self._current_index == self._latencies_count:
-                self._compute_latencies()
-                self._current_nsecs = {}
-                self._current_index = 0
+            if complete:
+                self._compute_latencies(times)
+                times = [None] * count
+                current = 0
+
+        self._current_index = current
+        self._current_nsecs = times
 
     def iteritems(self):
         _latencies = self._latencies
@@ -203,118 +343,134 @@ class Latencies:
             yield _values
 
     def flush(self):
-        self._compute_latencies()
-
-# --- Latencies analysis part ---
+        self._next_cycle()
+
+class PairLatencies(Latencies):
+    # A two-event chain (start, end) also fed by NumPy columns: each
+    # start followed by an end, without another start in between, makes
+    # a latency, as in the Latencies state machine
+    def update_columns(self, indexes, times):
+        numpy = PerfExtra.numpy()
+        if self._current_index == 1:
+            # The start left pending by the previous block
+            indexes = numpy.concatenate(([0], indexes))
+            times = numpy.concatenate(([self._current_nsecs[0]], times))
+        if not len(times):
+            return
 
-class Statistics:
-    def __init__(self, stats = None):
-        if stats is None:
-            self.min = 1000000000
-            self.max = 0
-            self.sum = 0
-            self.count = 0
+        starts = numpy.flatnonzero((indexes[:-1] == 0) & (indexes[1:] == 1))
+        if self._rate > 1:
+            from PerfExtra.sampling import sampled_columns
+            starts = starts[sampled_columns(self._rate, self._key,
+                                            times[starts])]
+        values = numpy.diff(times)[starts]
+        values = values[values < self._limit]
+        if len(values):
+            # The latency and the total of a two-event chain are the same
+            for i, previous in enumerate(self._latencies):
+                self._latencies[i] = numpy.concatenate((previous, values)) \
+                    if len(previous) else values
+
+        if indexes[-1] == 0:
+            self._current_index = 1
+            self._current_nsecs = [int(times[-1]), None]
         else:
-            self.min = stats.min
-            self.max = stats.max
-            self.sum = stats.sum
-            self.count = stats.count
-
-    def __iadd__(self, other):
-        if other.min < self.min:
-            self.min = other.min
-        if other.max > self.max:
-            self.max = other.max
-        self.sum += other.sum
-        self.count += other.count
-        return self
-
-    def __add__(self, other):
-        result = Statistics(stats = self)
-        result += other
-        return result
-
-    def update(self, value):
-        if value < self.min:
-            self.min = value
-        if value > self.max:
-            self.max = value
-        self.sum += value
-        self.count += 1
-
-    def get_values(self):
-        result = (0 , 0, 0) if self.count == 0 else \
-            (self.min, self.max, self.sum / self.count)
-        return result
-
-class Histogram:
-    def __init__(self, bucket_size = 10, buckets_count = 20, histo = None):
-        if histo is None:
-            self.step = bucket_size
-            self.count = buckets_count
-            self.buckets = [i for i in xrange(self.count)]
-            self.histo = [0 for i in xrange(self.count)]
-            self.overflow = 0
-            self.total = 0
+            self._current_index = 0
+            self._current_nsecs = [None, None]
+
+class MatchedLatencies(Latencies):
+    FIFO = 'fifo'
+
+    def __init__(self, names, limit, label, sample, match, inflight):
+        Latencies.__init__(self, names, limit, label, sample)
+
+        # Several cycles may be in flight at once: an event continues
+        # the oldest cycle waiting for it (FIFO) or the waiting cycle
+        # sharing its tag (the match attribute); at most inflight
+        # cycles wait for each event, the oldest one being evicted
+        self._match = match
+        self._inflight = inflight
+        waiting = collections.deque if match == MatchedLatencies.FIFO \
+            else collections.OrderedDict
+        self._waiting = [waiting() for n in self._names]
+
+    def _evict(self, times):
+        self.orphans[0] += 1
+        self._compute_latencies(times)
+
+    def _pop(self, index, tag):
+        waiting = self._waiting[index]
+        if self._match == MatchedLatencies.FIFO:
+            return waiting.popleft() if waiting else None
+        return waiting.pop(tag, None)
+
+    def _push(self, index, tag, times):
+        waiting = self._waiting[index]
+        if self._match == MatchedLatencies.FIFO:
+            if len(waiting) >= self._inflight:
+                self._evict(waiting.popleft())
+            waiting.append(times)
+            return
+
+        # A cycle restarted with the same tag replaces the waiting one
+        if tag in waiting:
+            self._evict(waiting.pop(tag))
+        elif len(waiting) >= self._inflight:
+            self._evict(waiting.popitem(last = False)[1])
+        waiting[tag] = times
+
+    def update(self, event):
+        # Skip the event if it is not in the list
+        index = self._name_to_index.get(event.name)
+        if index is None:
+            return
+
+        tag = None
+        if self._match != MatchedLatencies.FIFO:
+            tag = getattr(event, self._match)
+
+        # A start opens a new cycle, any other event continues the
+        # cycle waiting for it (if any)
+        if index == 0:
+            times = [None] * self._latencies_count
         else:
-            self.step = histo.step
-            self.count = histo.count
-            self.buckets = histo.buckets
-            self.histo = histo.histo[:]
-            self.overflow = histo.overflow
-            self.total = histo.total
-
-    def __iadd__(self, other):
-        for i, count in enumerate(other.histo):
-            self.histo[i] += count
-        self.overflow += other.overflow
-        self.total += other.total
-        return self
-
-    def __add__(self, other):
-        result = Histogram(histo = self)
-        result += other
-        return result
-
-    def update(self, value):
-        index = int(value / self.step)
-        if index < self.count:
-            self.histo[index] += 1
+            times = self._pop(index, tag)
+            if times is None:
+                self.orphans[1] += 1
+                return
+
+        times[index] = event.nsecs
+        if index + 1 == self._latencies_count:
+            self._compute_latencies(times)
         else:
-            self.overflow += 1
-        self.total += 1
+            self._push(index + 1, tag, times)
 
-    def get_values(self):
-        return self.histo
+    def update_many(self, events):
+        for event in events:
+            self.update(event)
 
-# --- Options management part ---
+    def flush(self):
+        # The cycles still in flight will never complete
+        for waiting in self._waiting:
+            cycles = waiting if self._match == MatchedLatencies.FIFO \
+                else waiting.values()
+            for times in cycles:
+                self._evict(times)
+            waiting.clear()
 
-class Options:
-    class Events:
-        NAME = 'events='
-        @staticmethod
-        def check(arg):
-            return arg[:len(Options.Events.NAME)] == Options.Events.NAME
-        def __init__(self, arg):
-            self.config = arg[len(Options.Events.NAME):].split(',')
+# --- Options management part ---
 
-    class Histo:
-        NAME = 'histo'
+class Options(PerfExtra.options.KeyedOptions):
+    class Chain:
+        NAME = 'chain='
         @staticmethod
         def check(arg):
-            return arg[:len(Options.Histo.NAME)] == Options.Histo.NAME
+            return arg[:len(Options.Chain.NAME)] == Options.Chain.NAME
         def __init__(self, arg):
-            bucket = 1000
-            count = 100
-            name = Options.Histo.NAME + '='
-            if arg[:len(name)] == name:
-                _arg = arg[len(name):].split(',')
-                if len(_arg) > 0:
-                    bucket = int(_arg[0])
-                if len(_arg) > 1:
-                    count = int(_arg[1])
-
-            self.config = (bucket, count)
+            label, _, names = arg[len(Options.Chain.NAME):].partition(':')
+            if not label or not names:
+                raise ValueError('A chain is given as label:evt0,evt1,...')
+            self.config = (label, names.split(','))
 
     class Limit:
         NAME = 'limit='
@@ -325,104 +481,411 @@ class Options:
             tmp = arg[len(Options.Limit.NAME):]
             self.config = int(tmp)
 
+    class Inflight:
+        NAME = 'inflight='
+        @staticmethod
+        def check(arg):
+            return arg[:len(Options.Inflight.NAME)] == Options.Inflight.NAME
+        def __init__(self, arg):
+            self.config = int(arg[len(Options.Inflight.NAME):])
+            if self.config <= 0:
+                raise ValueError('The in-flight cycles count must be positive')
+
+    class Match:
+        NAME = 'match='
+        @staticmethod
+        def check(arg):
+            return arg[:len(Options.Match.NAME)] == Options.Match.NAME
+        def __init__(self, arg):
+            self.config = arg[len(Options.Match.NAME):]
+            if not self.config:
+                raise ValueError('The cycles match fifo, a key or a field')
+
     def __init__(self, args):
-        self.events = []
-        self.histo = None
+        self.chains = []
+        self.inflight = 1024
+        self.match = None
         self.limit = int(0xffffffffffffffff)
 
-        for arg in args:
-            if Options.Events.check(arg):
-                self.events = Options.Events(arg).config
-            elif Options.Histo.check(arg):
-                self.histo = Options.Histo(arg).config
-            elif Options.Limit.check(arg):
-                self.limit = Options.Limit(arg).config
-            else:
-                raise ValueError('Unsupported options: ' + arg)
-
-        if len(self.events) < 2:
+        PerfExtra.options.KeyedOptions.__init__(self, args)
+
+        # The events= chain has no label; the events are the union of
+        # all the chains ones
+        if self.events:
+            self.chains.insert(0, (None, self.events))
+        if not self.chains:
             raise ValueError('Two events are needed at least')
+        for label, names in self.chains:
+            if len(names) < 2:
+                raise ValueError('Two events are needed at least')
+        labels = [l for l, n in self.chains]
+        if len(set(labels)) != len(labels):
+            raise ValueError('The chains labels must be unique')
+        self.events = []
+        for label, names in self.chains:
+            self.events += [n for n in names if n not in self.events]
+
+        # Cycles matched by tracepoint fields need them in the events
+        self.match_fields = None
+        if self.match not in (None, MatchedLatencies.FIFO) and \
+                self.match not in Options.Key.ATTRIBUTES:
+            self.match_fields = self.match.split(',')
+
+    def parse(self, arg):
+        if Options.Chain.check(arg):
+            self.chains.append(Options.Chain(arg).config)
+        elif Options.Limit.check(arg):
+            self.limit = Options.Limit(arg).config
+        elif Options.Inflight.check(arg):
+            self.inflight = Options.Inflight(arg).config
+        elif Options.Match.check(arg):
+            self.match = Options.Match(arg).config
+        else:
+            return PerfExtra.options.KeyedOptions.parse(self, arg)
+        return True
 
 # --- Report related part ---
 
-def print_legend(events):
-    names = events.get_names()
+def print_chain(chain):
+    # The latencies are grouped by chain (the events= one is unlabeled)
+    if chain is not None:
+        print '# --- Chain: {} ---'.format(chain)
 
+def print_legend(events):
     print '# === Legend ==='
-    legends = ['# L{:02d}: {}'.format(i, n) for i, n in enumerate(names)]
-    for legend in legends:
-        print legend
+    if events._config.sample > 1:
+        print '# Sampling: 1 in {} cycles, counts scaled'.format(
+            events._config.sample)
+    for chain, names in events.get_chains():
+        print_chain(chain)
+        legends = ['# L{:02d}: {}'.format(i, n) for i, n in names]
+        for legend in legends:
+            print legend
     
-def print_stats(events):
-    names = events.get_names()
-    cpus = events.get_cpus()
+def print_stats(events, delta = False):
+    keys = events.get_keys()
+    label = events._config.key + 's'
 
     print '# === Statistics: min avg max (ns) ==='
-    tmp = ['{:^23}'.format(c) for c in cpus]
-    print '# cpus: ' + ' | '.join(tmp)
-
-    for i, name in enumerate(names):
-        values = [events.get_statistics(c, name).get_values() for c in cpus]
-        tmp = ['{:07d} {:07d} {:07d}'.format(v[0], v[2], v[1]) for v in values]
-        line = '{:^6}: '.format('L{:02d}'.format(i)) + ' | '.join(tmp)
-        print line
-
-def print_histograms(events):
-    names = events.get_names()
-    cpus = events.get_cpus()
-    bucket, count = events._config.histo
+    tmp = ['{:^23}'.format(c) for c in keys]
+    print '# {}: '.format(label) + ' | '.join(tmp)
+
+    for chain, names in events.get_chains():
+        print_chain(chain)
+        for i, name in names:
+            values = [events.get_statistics(c, name, delta).get_values()
+                      for c in keys]
+            tmp = ['{:07d} {:07d} {:07d}'.format(v[0], v[2], v[1])
+                   for v in values]
+            line = '{:^6}: '.format('L{:02d}'.format(i)) + ' | '.join(tmp)
+            print line
 
-    print '# === Histograms: bucket:{}ns ==='.format(bucket)
+def print_percentiles(events, delta = False):
+    keys = events.get_keys()
+    label = events._config.key + 's'
+    percentiles = events._config.percentiles
+
+    tmp = ['p{:g}'.format(p) for p in percentiles]
+    print '# === Percentiles: {} (ns) ==='.format(' '.join(tmp))
+    key_format = '{:^SIZE}'.replace('SIZE', str(len(percentiles) * 8 - 1))
+    tmp = [key_format.format(c) for c in keys]
+    print '# {}: '.format(label) + ' | '.join(tmp)
+
+    for chain, names in events.get_chains():
+        print_chain(chain)
+        for i, name in names:
+            values = [events.get_statistics(c, name, delta)
+                      .get_percentiles(percentiles) for c in keys]
+            tmp = [' '.join(['{:07d}'.format(p) for p in v]) for v in values]
+            line = '{:^6}: '.format('L{:02d}'.format(i)) + ' | '.join(tmp)
+            print line
 
-    for i, name in enumerate(names):
-        tmp = ['{:^4}'.format(c) for c in cpus]
-        print ' L{:02d} \ cpus: '.format(i) + ' | '.join(tmp)
+def print_log_histograms(events, delta = False):
+    keys = events.get_keys()
+    label = events._config.key + 's'
+    digits = events._config.histo[1]
+
+    print '# === Histograms: log:{} digits ==='.format(digits)
+
+    for chain, names in events.get_chains():
+        print_chain(chain)
+        for i, name in names:
+            tmp = ['{:^4}'.format(c) for c in keys]
+            print ' L{:02d} \ {}: '.format(i, label) + ' | '.join(tmp)
+
+            histograms = [events.get_histogram(c, name, delta) for c in keys]
+            scale = events.get_scale()
+            buckets = histograms[-1].get_buckets()
+            values = [h.get_values() for h in histograms]
+            overflows = [h.overflow * scale for h in histograms]
+            totals = [h.total * scale for h in histograms]
+
+            # Only the non-empty buckets are printed (the last histogram
+            # gathers all the keys)
+            for i, bucket in enumerate(buckets):
+                if values[-1][i] == 0:
+                    continue
+                tmp =  ['{:04d}'.format(v[i] * scale) for v in values]
+                line = '{:011d}: '.format(bucket) + ' | '.join(tmp)
+                print line
+
+            tmp =  ['{:04d}'.format(o) for o in overflows]
+            line  = ' overflows : ' + ' | '.join(tmp)
+            print line
 
-        histograms = [events.get_histogram(c, name) for c in cpus]
-        values = [h.get_values() for h in histograms]
-        overflows = [h.overflow for h in histograms]
-        totals = [h.total for h in histograms]
+            tmp =  ['{:04d}'.format(o) for o in totals]
+            line  = '  totals   : ' + ' | '.join(tmp)
+            print line
 
-        for i in xrange(count):
-            tmp =  ['{:04d}'.format(v[i]) for v in values]
-            line = '{:011d}: '.format(i * bucket) + ' | '.join(tmp)
+def print_histograms(events, delta = False):
+    keys = events.get_keys()
+    label = events._config.key + 's'
+    bucket, count = events._config.histo
+
+    print '# === Histograms: bucket:{}ns ==='.format(bucket)
+
+    for chain, names in events.get_chains():
+        print_chain(chain)
+        for i, name in names:
+            tmp = ['{:^4}'.format(c) for c in keys]
+            print ' L{:02d} \ {}: '.format(i, label) + ' | '.join(tmp)
+
+            histograms = [events.get_histogram(c, name, delta) for c in keys]
+            scale = events.get_scale()
+            values = [h.get_values() for h in histograms]
+            overflows = [h.overflow * scale for h in histograms]
+            totals = [h.total * scale for h in histograms]
+
+            for i in xrange(count):
+                tmp =  ['{:04d}'.format(v[i] * scale) for v in values]
+                line = '{:011d}: '.format(i * bucket) + ' | '.join(tmp)
+                print line
+
+            tmp =  ['{:04d}'.format(o) for o in overflows]
+            line  = ' overflows : ' + ' | '.join(tmp)
             print line
 
-        tmp =  ['{:04d}'.format(o) for o in overflows]
-        line  = ' overflows : ' + ' | '.join(tmp)
-        print line
+            tmp =  ['{:04d}'.format(o) for o in totals]
+            line  = '  totals   : ' + ' | '.join(tmp)
+            print line
 
-        tmp =  ['{:04d}'.format(o) for o in totals]
-        line  = '  totals   : ' + ' | '.join(tmp)
-        print line
+def print_late(events):
+    keys = events.get_keys()
+    label = events._config.key + 's'
+
+    print '# === Late events: window:{}ns ==='.format(events._config.window)
+    tmp = ['{:^4}'.format(c) for c in keys]
+    print '# {}: '.format(label) + ' | '.join(tmp)
+
+    tmp = ['{:04d}'.format(events.get_late(c)) for c in keys]
+    print ' late : ' + ' | '.join(tmp)
+
+def print_orphans(events):
+    keys = events.get_keys()
+    label = events._config.key + 's'
+    orphans = [events.get_orphans(c) for c in keys]
+
+    print '# === Orphan cycles: match:{} inflight:{} ==='.format(
+        events._config.match, events._config.inflight)
+    tmp = ['{:^4}'.format(c) for c in keys]
+    print '# {}: '.format(label) + ' | '.join(tmp)
+
+    for i, (chain, names) in enumerate(events.get_chains()):
+        print_chain(chain)
+        tmp = ['{:04d}'.format(o[i][0]) for o in orphans]
+        print ' starts : ' + ' | '.join(tmp)
+        tmp = ['{:04d}'.format(o[i][1]) for o in orphans]
+        print ' ends   : ' + ' | '.join(tmp)
+
+def print_report(events, delta = False):
+    print_stats(events, delta)
+    if config.percentiles:
+        print_percentiles(events, delta)
+    if config.histo and config.histo[0] == 'log':
+        print_log_histograms(events, delta)
+    elif config.histo:
+        print_histograms(events, delta)
+
+def print_interval(events, start, end):
+    # The interval statistics are followed by the cumulative ones
+    print '# === Interval: {}-{}ns ==='.format(start, end)
+    print_legend(events)
+    print_report(events, delta = True)
+    print '# === Cumulative: up to {}ns ==='.format(end)
+    print_report(events)
+    # The live reports go through pipes
+    sys.stdout.flush()
+
+def print_profile(events, profile):
+    from PerfExtra.profile import Profile, print_profile_stages
+    print '# === Profile: 1 in {} per-event calls timed ==='.format(
+        Profile.SAMPLING)
+    late = events.get_late('all')
+    print_profile_stages(profile, ('unhandled', 'handlers', 'process',
+                                   'report'),
+                         ('unhandled', 'handlers', 'report'))
+    outside = profile.get_calls('outside')
+    print ' outside   : {:010d} (out of start= and stop=)'.format(outside)
+    print ' dropped   : {:010d} (unconfigured or filtered)'.format(
+        profile.get_calls('unhandled') + profile.get_calls('handlers') -
+        profile.sorted - late - outside)
+    print ' late      : {:010d}'.format(late)
+    print ' sorted    : {:010d} ({} batches)'.format(
+        profile.sorted, profile.get_calls('process'))
+
+    keys = sorted(profile.peaks)
+    tmp = ['{:^6}'.format(k) for k in keys]
+    print '# {}: '.format(events._config.key + 's') + ' | '.join(tmp)
+    tmp = ['{:06d}'.format(profile.peaks[k]) for k in keys]
+    print ' peak buffer : ' + ' | '.join(tmp)
 
 # --- Perf related part ---
 
 events = None
+cache = None
 config = None
+profile = None
+
+# The predicate and tag extractor compiled from the options
+accept = None
+tag = None
+
+# The trace time bounds, with the blocks selection (the cycles are
+# sampled by the latencies themselves)
+start = 0
+stop = float('inf')
+select = None
 
 def trace_unhandled(event_name, context, fields):
-    args = (event_name, 
-            context,
-            fields['common_cpu'],
-            Util.nsecs(fields['common_s'], fields['common_ns']),
-            fields['common_pid'], fields['common_comm'])
-    event = Event(*args)
+    # The cache keeps every event, whatever the configuration
+    if cache is not None:
+        cache.append(event_name, fields['common_cpu'],
+                     Util.nsecs(fields['common_s'], fields['common_ns']),
+                     fields['common_pid'], fields['common_comm'])
+
+    if event_name not in events.ids:
+        return
+
+    # Out of bounds and filtered out events are dropped before any
+    # processing
+    nsecs = Util.nsecs(fields['common_s'], fields['common_ns'])
+    if not start <= nsecs < stop:
+        if profile is not None:
+            profile.stats('outside')[0] += 1
+        return
+    if accept is not None and not accept(fields):
+        return
+
+    event = Event(event_name,
+                  context,
+                  fields['common_cpu'],
+                  nsecs,
+                  fields['common_pid'], fields['common_comm'])
+    if tag is not None:
+        event.tag = tag(fields)
     events.append(event)
 
+
+def get_batch_ids():
+    # The front-ends (see replay.py) may push blocks of events through
+    # trace_batch() with these name ids, unless every event must go
+    # through the handlers (cache, fields or profiling)
+    if cache or accept or tag or profile:
+        return None
+    return events.ids
+
+def trace_batch(columns):
+    if select is not None:
+        columns = select(columns)
+        if columns is None:
+            return
+    events.append_many(columns)
+
 def trace_begin():
     # Parse the script-specific options
     global config
     config = Options(sys.argv[1:])
 
+    global cache
+    if config.cache:
+        from PerfExtra.output import Cache
+        cache = Cache(config.cache)
+
+    # Compile the fields filters and matching, once for all events
+    global accept, tag
+    if config.filters:
+        from PerfExtra.fields import compile_filter
+        accept = compile_filter(config.filters)
+    if config.match_fields:
+        from PerfExtra.fields import compile_match
+        tag = compile_match(config.match_fields)
+
+    global start, stop, select
+    start, stop = config.start, config.stop
+    if start > 0 or stop < float('inf'):
+        from PerfExtra.sampling import new_selector
+        select = new_selector(start, stop)
+
     # Instanciate the global events holder
     global events
-    events = Events(config)
+    raw = None
+    if config.raw:
+        from PerfExtra.output import NpyWriter
+        raw = NpyWriter(config.output + '.raw.npy', 3)
+    events = Events(config, print_interval, raw)
+    if config.live:
+        from PerfExtra.live import catch_signals
+        catch_signals(events.clock)
+
+    # The profiled stages are wrapped (only then, to leave the normal
+    # path untouched)
+    global profile
+    if config.profile:
+        from PerfExtra.profile import Profile
+        profile = Profile()
+        def peak(key, batch):
+            profile.sorted += len(batch)
+            profile.peak(key, len(events._events[key]))
+        events._process = profile.time('process', events._process,
+                                       probe = peak)
+        globals()['trace_unhandled'] = profile.time(
+            'unhandled', trace_unhandled, Profile.SAMPLING)
+        globals()['print_report'] = profile.time('report', print_report)
+
+    # The configured events get their own handler, unless the cache or
+    # the fields filtering and matching need every fields dict
+    if not (cache or accept or tag):
+        for name in events.ids:
+            stats = profile.stats('handlers') if profile else None
+            outside = profile.stats('outside') if profile else None
+            globals()[name] = new_handler(name, events.append, stats,
+                                          start, stop, outside = outside)
 
 def trace_end():
+    if cache is not None:
+        cache.close()
+
     events.flush()
     # Print the results (according to the configuration)
     print_legend(events)
-    print_stats(events)
-    if config.histo:
-        print_histograms(events)
+    print_report(events)
+    print_late(events)
+    if config.match:
+        print_orphans(events)
+
+    # Export the results (and complete the raw values, then save the
+    # snapshot)
+    if config.output:
+        from PerfExtra.output import export_histograms, export_stats
+        export_stats(events, config.output)
+        if config.histo:
+            export_histograms(events, config.output)
+    if config.raw:
+        events._raw.close()
+    if config.snapshot:
+        from PerfExtra.snapshot import save
+        save(config.snapshot, os.path.basename(__file__), sys.argv[1:], events)
+
+    if profile is not None:
+        print_profile(events, profile)
+
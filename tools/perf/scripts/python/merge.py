@@ -0,0 +1,67 @@
+
+# Merge the snapshots of a script results (see the snapshot= option),
+# e.g. from several runs or hosts, and print the combined report,
+# without the traces
+#
+# usage: python merge.py [--hosts] [-o snapshot-file] snapshot-file...
+#
+# The results of the same keys (cpus, tasks or commands) are added; with
+# --hosts, each host gets a key of its own, in place of the cpus. The
+# snapshots must come from the same script with the same events and
+# results options (the time bounds, reordering or output ones may
+# differ).
+
+import argparse
+import os
+import sys
+
+# The shared modules are next to the scripts (see replay.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'Perf-Trace-Util', 'lib', 'Perf', 'Trace'))
+
+import replay
+
+from PerfExtra.snapshot import get_shape, load, save
+
+def merge(paths, hosts = False, output = None):
+    snapshots = [load(p) for p in paths]
+    first = snapshots[0]
+    shape = get_shape(first['options'])
+    for path, snapshot in zip(paths, snapshots):
+        if snapshot['script'] != first['script'] or \
+                get_shape(snapshot['options']) != shape:
+            raise ValueError('Snapshot of another script or options: ' + path)
+
+    # The script reports the merged results (the window of the first
+    # snapshot only labels the late events)
+    options = shape + [o for o in first['options']
+                       if o.startswith('window=')]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        first['script'])
+    script = replay.load_script(path, options)
+    script.trace_begin()
+
+    holder = replay.results(script)
+    for snapshot in snapshots:
+        holder.restore(snapshot['state'], snapshot['host'] if hosts else None)
+    if hosts and hasattr(script.config, 'key'):
+        script.config.key = 'host'
+
+    if output:
+        names = sorted(set([s['host'] for s in snapshots]))
+        save(output, first['script'], options, holder, ','.join(names))
+    script.trace_end()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Merge snapshots of a script results')
+    parser.add_argument('--hosts', action = 'store_true',
+                        help = 'one key per host, in place of the cpus')
+    parser.add_argument('-o', '--output', help = 'merged snapshot file')
+    parser.add_argument('snapshots', nargs = '+', help = 'snapshot files')
+    args = parser.parse_args()
+
+    merge(args.snapshots, args.hosts, args.output)
+
+if __name__ == '__main__':
+    main()
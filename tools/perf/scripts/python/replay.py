@@ -0,0 +1,246 @@
+
+# Replay a cache of events (see the cache= option of the scripts)
+# through a script, without perf
+#
+# usage: python replay.py [-j jobs] cache-file script.py [script options]
+#
+# With several jobs, the cpus are sharded among worker processes, each
+# one replaying the events of its cpus; the per-cpu results are merged
+# back before the report. Each worker selects the rows of its cpus by
+# chunk, with NumPy when it is installed, so that the sharding costs
+# little next to the replay itself.
+
+import argparse
+import array
+import imp
+import itertools
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import types
+
+# The shared modules are next to the scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'Perf-Trace-Util', 'lib', 'Perf', 'Trace'))
+
+import PerfExtra
+
+# --- Perf emulation part ---
+
+def install_util():
+    # The scripts only need Util.nsecs(); the replayed events give
+    # their timestamps in common_ns (common_s being 0)
+    if 'Util' in sys.modules:
+        return
+    util = types.ModuleType('Util')
+    util.NSECS_PER_SEC = 1000000000
+    util.nsecs = lambda secs, nsecs: secs * util.NSECS_PER_SEC + nsecs
+    sys.modules['Util'] = util
+
+def load_script(path, options):
+    install_util()
+    sys.argv = [path] + options
+    name = os.path.splitext(os.path.basename(path))[0]
+    return imp.load_source(name, path)
+
+# --- Cache reading part ---
+
+class CacheReader:
+    # The layout matches the Cache class of the scripts
+    MAGIC = 'PXCACHE2'
+    TYPECODES = 'HHLlL'
+    BYTEORDER = '<' if sys.byteorder == 'little' else '>'
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0,
+                              access = mmap.ACCESS_READ)
+
+        header = len(CacheReader.MAGIC) + 2 * len(CacheReader.TYPECODES) + 1
+        magic = self._map[:len(CacheReader.MAGIC)]
+        offset = len(magic) + len(CacheReader.TYPECODES)
+        typecodes = self._map[len(magic):offset]
+        sizes = [ord(c) for c in self._map[offset:header - 1]]
+        byteorder = self._map[header - 1:header]
+        if magic != CacheReader.MAGIC or typecodes != CacheReader.TYPECODES:
+            raise ValueError('Not an events cache: ' + path)
+        self._sizes = [array.array(t).itemsize for t in typecodes]
+        if sizes != self._sizes or byteorder != CacheReader.BYTEORDER:
+            raise ValueError('Events cache from an incompatible host: ' + path)
+
+        # The tables lengths are at the very end of the file
+        end = len(self._map) - struct.calcsize('<QQ')
+        names_size, comms_size = struct.unpack('<QQ', self._map[end:])
+        tables = end - names_size - comms_size
+        self.names = self._map[tables:tables + names_size].split('\0')
+        self.comms = self._map[tables + names_size:end].split('\0')
+
+        self._start = header
+        self._end = tables
+
+    def chunks(self, shard = 0, jobs = 1):
+        # Each chunk is given as its list of columns; with several jobs,
+        # only with the rows of the shard cpus (the chunks without any
+        # are skipped)
+        numpy = PerfExtra.numpy() if jobs > 1 else None
+        offset = self._start
+        while offset < self._end:
+            count, = struct.unpack_from('<I', self._map, offset)
+            offset += 4
+            if numpy is not None:
+                columns = self._select(numpy, offset, count, shard, jobs)
+            else:
+                columns = self._read(offset, count, shard, jobs)
+            offset += count * sum(self._sizes)
+            if columns is not None:
+                yield columns
+
+    def _read(self, offset, count, shard, jobs):
+        columns = []
+        for typecode, size in zip(CacheReader.TYPECODES, self._sizes):
+            column = array.array(typecode)
+            column.fromstring(self._map[offset:offset + count * size])
+            columns.append(column)
+            offset += count * size
+        if jobs == 1:
+            return columns
+
+        rows = [r for r in itertools.izip(*columns) if r[1] % jobs == shard]
+        return [list(c) for c in zip(*rows)] if rows else None
+
+    def _select(self, numpy, offset, count, shard, jobs):
+        # The columns are mapped in place and the rows of the shard are
+        # gathered by a single mask (then handed over as lists of Python
+        # values, as the scripts expect)
+        columns = []
+        for typecode, size in zip(CacheReader.TYPECODES, self._sizes):
+            columns.append(numpy.frombuffer(self._map, typecode, count,
+                                            offset))
+            offset += count * size
+        rows = numpy.flatnonzero(columns[1] % jobs == shard)
+        if not len(rows):
+            return None
+        return [c.take(rows).tolist() for c in columns]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+# --- Replay part ---
+
+def replay_batches(reader, script, ids, shard = 0, jobs = 1):
+    # The cache chunks are pushed as whole blocks, their name indexes
+    # translated once to the script ids (-1 for unconfigured events)
+    translate = [ids.get(n, -1) for n in reader.names]
+    comms = reader.comms
+
+    for names, cpus, times, pids, comm_indexes in reader.chunks(shard, jobs):
+        script.trace_batch(([translate[n] for n in names], cpus, times,
+                            pids, [comms[c] for c in comm_indexes]))
+
+def replay(reader, script, shard = 0, jobs = 1):
+    # Scripts accepting blocks of events are given the whole chunks
+    get_batch_ids = getattr(script, 'get_batch_ids', None)
+    ids = get_batch_ids() if get_batch_ids is not None else None
+    if ids is not None:
+        replay_batches(reader, script, ids, shard, jobs)
+        return
+
+    unhandled = script.trace_unhandled
+    names = reader.names
+    comms = reader.comms
+
+    # Like perf, the <subsystem>__<event> handlers of the script are
+    # preferred and given positional arguments (without callchain)
+    handlers = [getattr(script, n, None) if '__' in n else None
+                for n in names]
+
+    for chunk in reader.chunks(shard, jobs):
+        for name, cpu, nsecs, pid, comm in itertools.izip(*chunk):
+            handler = handlers[name]
+            if handler is not None:
+                handler(names[name], None, cpu, 0, nsecs, pid, comms[comm],
+                        None)
+                continue
+            fields = {'common_cpu': cpu, 'common_s': 0, 'common_ns': nsecs,
+                      'common_pid': pid, 'common_comm': comms[comm]}
+            unhandled(names[name], None, fields)
+
+# --- Parallel part ---
+
+# Options which cannot be honoured when the cpus are split among workers
+SEQUENTIAL = ('interval', 'raw', 'stream', 'cache', 'profile')
+
+def results(script):
+    # The holder of the per-cpu results of a script
+    if hasattr(script, 'timeslots'):
+        return script.timeslots
+    return script.events
+
+def work(args):
+    path, script_path, options, shard, jobs = args
+
+    # Only the parent writes the outputs
+    script = load_script(script_path, options)
+    sys.argv = [script_path] + \
+        [o for o in options if not script.Options.Output.check(o)]
+
+    reader = CacheReader(path)
+    script.trace_begin()
+    replay(reader, script, shard, jobs)
+    reader.close()
+
+    holder = results(script)
+    holder.flush()
+    return holder
+
+def replay_parallel(path, script_path, options, jobs):
+    script = load_script(script_path, options)
+    config = script.Options(options)
+    for name in SEQUENTIAL:
+        if getattr(config, name, None):
+            raise ValueError('Option unsupported with several jobs: ' + name)
+    # The shards hold whole cpus: other keys would be split among them
+    if getattr(config, 'key', 'cpu') != 'cpu':
+        raise ValueError('Only the cpu key is supported with several jobs')
+
+    pool = multiprocessing.Pool(jobs)
+    shards = pool.map(work, [(path, script_path, options, shard, jobs)
+                             for shard in range(jobs)])
+    pool.close()
+    pool.join()
+
+    script.trace_begin()
+    holder = results(script)
+    for shard in shards:
+        holder.merge(shard)
+    script.trace_end()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Replay a cache of events through a script')
+    parser.add_argument('-j', '--jobs', type = int, default = 1,
+                        help = 'number of worker processes')
+    parser.add_argument('cache', help = 'events cache file')
+    parser.add_argument('script', help = 'script to replay the events through')
+    parser.add_argument('options', nargs = argparse.REMAINDER,
+                        help = 'script options')
+    args = parser.parse_args()
+
+    if args.jobs > 1:
+        replay_parallel(args.cache, args.script, args.options, args.jobs)
+        return
+
+    reader = CacheReader(args.cache)
+    script = load_script(args.script, args.options)
+
+    script.trace_begin()
+    replay(reader, script)
+    script.trace_end()
+
+    reader.close()
+
+if __name__ == '__main__':
+    main()
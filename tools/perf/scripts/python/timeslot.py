@@ -1,78 +1,269 @@
 
+import collections
+import csv
+import heapq
+import itertools
 import os
 import sys
 
-sys.path.append(os.environ['PERF_EXEC_PATH'] + \
-	'/scripts/python/Perf-Trace-Util/lib/Perf/Trace')
+# Outside of perf (see replay.py), a stub Util module is provided; the
+# shared modules are next to perf's ones, under the scripts directory
+if 'PERF_EXEC_PATH' in os.environ:
+    sys.path.append(os.environ['PERF_EXEC_PATH'] + \
+        '/scripts/python/Perf-Trace-Util/lib/Perf/Trace')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'Perf-Trace-Util', 'lib', 'Perf', 'Trace'))
 
 import Util 
 
-# --- Events management part ---
+import PerfExtra
+import PerfExtra.options
 
-class Event:
-    ARGS = ('name', 'context', 'cpu', 'nsecs', 'pid', 'comm')
-
-    def __init__(self, *args, **keywords):
-        # Basic checking
-        assert len(args) == len(Event.ARGS)
-
-        # Set the mandatory arguments...
-        for i, arg in enumerate(Event.ARGS):
-            setattr(self, arg, args[i])
-
-        # ...and the optional ones (one never knows)
-        for key, value in keywords.iteritems():
-            setattr(self, key, value)
+# The modules of the options (output, live, profile, sampling and
+# snapshot) are only imported when the options are set
+from PerfExtra.events import Event
+from PerfExtra.handlers import new_handler
+from PerfExtra.stats import add_counters, new_counters, view_counters
 
 # --- Timeslot generation part ---
 
 class Timeslot:
-    def __init__(self):
-        self.counts = {}
+    def __init__(self, width, cpus_count):
+        # The counters are laid out by cpu index then by event index
+        self.width = width
+        self.counts = new_counters(width * cpus_count)
+
+    def __iadd__(self, other):
+        # Same layout, up to the cpus discovered in between
+        missing = len(other.counts) - len(self.counts)
+        if missing > 0:
+            self.counts.extend(new_counters(missing))
+        add_counters(self.counts, other.counts)
+        return self
 
     def __getitem__(self, key):
-        return self.counts[key] if key in self.counts else 0
-
-    def append(self, event):
-        key = (event.cpu, event.name)
-        self.counts[key] = self.counts.get(key, 0) + 1
-        key = ('all', event.name)
-        self.counts[key] = self.counts.get(key, 0) + 1
-
-    def keys(self):
-        return self.counts.keys()
-
-    def cpus(self):
-        return set([k[0] for k in self.counts.keys()])
+        cpu_index, name_index = key
+        offset = cpu_index * self.width + name_index
+        return self.counts[offset] if offset < len(self.counts) else 0
+
+    def append(self, cpu_index, name_index):
+        offset = cpu_index * self.width + name_index
+        # The cpus discovered after the slot creation extend it
+        if offset >= len(self.counts):
+            missing = (cpu_index + 1) * self.width - len(self.counts)
+            self.counts.extend(new_counters(missing))
+        self.counts[offset] += 1
+
+    def add_row(self, cpu_index, row):
+        offset = cpu_index * self.width
+        if offset + self.width > len(self.counts):
+            missing = offset + self.width - len(self.counts)
+            self.counts.extend(new_counters(missing))
+        for i, count in enumerate(row):
+            self.counts[offset + i] += count
+
+    def get_row(self, cpu_index):
+        row = self.counts[cpu_index * self.width:(cpu_index + 1) * self.width]
+        return row if len(row) == self.width else new_counters(self.width)
+
+    def get_total(self):
+        # The 'all' row is the sum of the cpus rows
+        if len(self.counts) > 0 and PerfExtra.numpy() is not None:
+            view = view_counters(self.counts).reshape(-1, self.width)
+            return view.sum(axis = 0).tolist()
+
+        total = new_counters(self.width)
+        for i, count in enumerate(self.counts):
+            total[i % self.width] += count
+        return total
 
 class Timeslots:
-    def __init__(self, slot_nsecs):
+    def __init__(self, slot_nsecs, names, window = None, emit = None,
+                 clock = None, on_live = None):
         self.slot_nsecs = slot_nsecs
         self.timeslots = {}
 
+        # Event names and cpus are translated into counters indexes
+        self.ids = dict((n.replace(':', '__'), i)
+                        for i, n in enumerate(names))
+        self._width = len(names)
+        self._cpu_to_index = {}
+
+        # In streaming mode, the slots older than the newest event by
+        # more than the window are handed to emit() and freed
+        self._window = window
+        self._emit = emit
+        self._indexes = []
+        self._newest = 0
+        self._floor = 0
+        self.late = 0
+
+        # In live mode, the wall clock (see live.Clock) releases the
+        # slots of the quiet cpus too and calls on_live() periodically
+        # or on request
+        self._clock = clock
+        self._on_live = on_live
+
     def __getitem__(self, key):
         return self.timeslots[key]
 
+    def _release(self, floor):
+        self._floor = floor
+        indexes = self._indexes
+        while indexes and indexes[0] < floor:
+            index = heapq.heappop(indexes)
+            self._emit(self, index, self.timeslots.pop(index))
+
+    def _add_cpu(self, cpu):
+        cpu_index = len(self._cpu_to_index)
+        self._cpu_to_index[cpu] = cpu_index
+        return cpu_index
+
+    def _add_slot(self, index):
+        slot = Timeslot(self._width, len(self._cpu_to_index))
+        self.timeslots[index] = slot
+        if self._emit is not None:
+            heapq.heappush(self._indexes, index)
+        return slot
+
     def append(self, event):
+        # An event of an already emitted slot cannot be counted anymore
         index = event.nsecs / self.slot_nsecs
-        tmp = self.timeslots.get(index, Timeslot())
-        tmp.append(event)
-        self.timeslots[index] = tmp
+        if index < self._floor:
+            self.late += 1
+            return
+
+        cpu_index = self._cpu_to_index.get(event.cpu)
+        if cpu_index is None:
+            cpu_index = self._add_cpu(event.cpu)
+
+        slot = self.timeslots.get(index)
+        if slot is None:
+            slot = self._add_slot(index)
+
+        # Unconfigured events only mark the slot (and cpu) as active
+        name_index = self.ids.get(event.name)
+        if name_index is not None:
+            slot.append(cpu_index, name_index)
+
+        if self._emit is not None and event.nsecs > self._newest:
+            self._newest = event.nsecs
+            floor = (self._newest - self._window) / self.slot_nsecs
+            if floor > self._floor:
+                self._release(floor)
+
+        if self._clock is not None and self._clock.tick(event.nsecs):
+            floor = self._clock.until() / self.slot_nsecs
+            if floor > self._floor:
+                self._release(floor)
+            self._on_live(self, self._clock.periodic)
+
+    def append_many(self, columns):
+        # Same as append(), over parallel columns (name ids, cpus, nsecs,
+        # ...), the ids being the self.ids ones (negative for the
+        # unconfigured events, which only mark their slot active)
+        name_ids, cpus, times = columns[:3]
+        if self._emit is not None:
+            # The streamed slots are released as the events come
+            names = dict((i, n) for n, i in self.ids.iteritems())
+            for row in itertools.izip(*columns):
+                self.append(Event(names.get(row[0]), None, *row[1:]))
+            return
+
+        slot_nsecs = self.slot_nsecs
+        floor = self._floor
+        timeslots = self.timeslots
+        cpu_to_index = self._cpu_to_index
+
+        for name_id, cpu, nsecs in itertools.izip(name_ids, cpus, times):
+            index = nsecs / slot_nsecs
+            if index < floor:
+                self.late += 1
+                continue
+
+            cpu_index = cpu_to_index.get(cpu)
+            if cpu_index is None:
+                cpu_index = self._add_cpu(cpu)
+
+            slot = timeslots.get(index)
+            if slot is None:
+                slot = self._add_slot(index)
+
+            if name_id >= 0:
+                slot.append(cpu_index, name_id)
+
+    def flush(self):
+        if self._emit is not None and self._indexes:
+            self._release(max(self._indexes) + 1)
+
+    def merge(self, other):
+        # Combine the slots of another instance, e.g. the cpus of a
+        # shard processed elsewhere
+        for cpu in other.cpus():
+            if cpu not in self._cpu_to_index:
+                self._add_cpu(cpu)
+        self.late += other.late
+
+        for index, slot in other.timeslots.iteritems():
+            mine = self.timeslots.get(index)
+            if mine is None:
+                mine = self._add_slot(index)
+            for cpu in other.cpus():
+                mine.add_row(self._cpu_to_index[cpu],
+                             slot.get_row(other.cpu_index(cpu)))
+
+    def get_state(self):
+        # The slots counters, as saved in the snapshots (see snapshot.py)
+        from PerfExtra.snapshot import encode_counters
+        cpus = self.cpus()
+        slots = []
+        for index in sorted(self.timeslots):
+            slot = self.timeslots[index]
+            rows = sum([list(slot.get_row(self._cpu_to_index[c]))
+                        for c in cpus], [])
+            slots.append([index, encode_counters(rows)])
+        return {'slot': self.slot_nsecs, 'width': self._width,
+                'cpus': cpus, 'slots': slots, 'late': self.late}
+
+    def restore(self, state, host = None):
+        # Add the slots of a snapshot state, under their own cpus or all
+        # under the host one (the slots then start with the first one,
+        # the hosts clocks being unrelated)
+        if state['slot'] != self.slot_nsecs or state['width'] != self._width:
+            raise ValueError('Snapshot of other slots or events')
+        from PerfExtra.snapshot import decode_counters
+
+        cpus = state['cpus'] if host is None else [host] * len(state['cpus'])
+        for cpu in cpus:
+            if cpu not in self._cpu_to_index:
+                self._add_cpu(cpu)
+        cpu_indexes = [self._cpu_to_index[c] for c in cpus]
+        self.late += state['late']
+
+        first = state['slots'][0][0] if host is not None and state['slots'] \
+            else 0
+        for index, counters in state['slots']:
+            rows = new_counters(len(cpus) * self._width)
+            decode_counters(rows, counters)
+            slot = self.timeslots.get(index - first)
+            if slot is None:
+                slot = self._add_slot(index - first)
+            for i, cpu_index in enumerate(cpu_indexes):
+                slot.add_row(cpu_index,
+                             rows[i * self._width:(i + 1) * self._width])
 
     def keys(self):
         return self.timeslots.keys()
 
-# --- Options management part ---
+    def cpus(self):
+        return sorted(self._cpu_to_index.keys())
 
-class Options:
-    class Events:
-        NAME = 'events='
-        @staticmethod
-        def check(arg):
-            return arg[:len(Options.Events.NAME)] == Options.Events.NAME
-        def __init__(self, arg):
-            self.config = arg[len(Options.Events.NAME):].split(',')
+    def cpu_index(self, cpu):
+        return self._cpu_to_index[cpu]
+
+# --- Options management part ---
 
+class Options(PerfExtra.options.Options):
     class Slot:
         NAME = 'slot='
         @staticmethod
@@ -81,90 +272,361 @@ class Options:
         def __init__(self, arg):
             self.config = int(arg[len(Options.Slot.NAME):])
 
+    class Stream:
+        NAME = 'stream'
+        @staticmethod
+        def check(arg):
+            return arg == Options.Stream.NAME
+
     def __init__(self, args):
-        self.events = []
         self.slot_nsecs = 100000 # 100us
+        self.stream = False
 
-        for arg in args:
-            if Options.Events.check(arg):
-                self.events = Options.Events(arg).config
-            elif Options.Slot.check(arg):
-                self.slot_nsecs = Options.Slot(arg).config
-            else:
-                raise ValueError('Unsupported options: ' + arg)
+        PerfExtra.options.Options.__init__(self, args)
 
         if len(self.events) < 1:
             raise ValueError('One event is needed at least')
 
+        # The streamed slots are not kept
+        if self.snapshot and (self.stream or self.live):
+            raise ValueError('Snapshots need every slot: no stream nor live')
+
+    def parse(self, arg):
+        if Options.Slot.check(arg):
+            self.slot_nsecs = Options.Slot(arg).config
+        elif Options.Stream.check(arg):
+            self.stream = True
+        else:
+            return PerfExtra.options.Options.parse(self, arg)
+        return True
+
 # --- Report related part ---
 
 def print_legend():
     print '# === Legend ==='
+    if config.sample > 1:
+        print '# Sampling: 1 in {} events, counts scaled'.format(
+            config.sample)
     for i, name in enumerate(config.events):
         line = '# E{:02d}: '.format(i) + name
         print line
 
-def print_timeslots(timeslots):
+def print_title():
     print '# === Timeslots (slot duration: {}ns) ==='.format(config.slot_nsecs)
-    
-    indexes = timeslots.keys()
-    # Theoretically, the sort is useless, here
-    indexes.sort()
-
-    names = [e.replace(':', '__') for e in config.events]
 
-    cpus = set()
-    for index in indexes:
-        cpus |= timeslots[index].cpus()
+class Report:
+    def __init__(self, export = None):
+        self._export = export
+        self._cpus = None
+        self._first = None
+        self._next = None
+
+    def _print_header(self, cpus):
+        names = config.events
+
+        cpu_format = '{:^SIZE}'.replace('SIZE', str(len(names) * 4 - 1))
+        cpus_strings = [cpu_format.format(i) for i in cpus + ['all']]
+        print '#  cpus   : ' + ' | '.join(cpus_strings)
+
+        names_strings = ['E{:02d}'.format(i) for i, _ in enumerate(names)]
+        names_strings =  ' '.join(names_strings)
+        names_strings = [names_strings] * (len(cpus) + 1)
+        print '# ns\evts : ' + ' | '.join(names_strings)
+
+    def emit(self, timeslots, index, slot):
+        # The header is printed again whenever new cpus show up
+        cpus = timeslots.cpus()
+        if cpus != self._cpus:
+            self._print_header(cpus)
+            self._cpus = cpus
+
+        if self._first is None:
+            self._first = index
+
+        # In streaming mode, the runs of empty slots are summed up in a
+        # single line
+        if config.stream and self._next is not None and index > self._next:
+            nsecs = (self._next - self._first) * config.slot_nsecs
+            print '# {:010d}: {} empty slots'.format(nsecs, index - self._next)
+        self._next = index + 1
+
+        cpus_indexes = [timeslots.cpu_index(c) for c in cpus]
+        rows = [slot.get_row(i) for i in cpus_indexes] + [slot.get_total()]
+
+        # The sampled counts are scaled back (the slots keep them as is)
+        percpu_counts = [' '.join(['{:03d}'.format(t * config.sample)
+                                   for t in row])
+                         for row in rows]
+
+        nsecs = (index - self._first) * config.slot_nsecs
+        line = '{:010d}: '.format(nsecs)
+        line += ' | '.join(percpu_counts)
+        print line
 
-    cpu_format = '{:^SIZE}'.replace('SIZE', str(len(names) * 4 - 1))
-    cpus_strings = [cpu_format.format(i) for i in cpus]
-    print '#  cpus   : ' + ' | '.join(cpus_strings)
+        if self._export is not None:
+            self._export.emit(timeslots, index, slot)
+
+class Period:
+    # The slots emitted during a live period, summed up
+    def __init__(self, width):
+        self.counts = Timeslot(width, 0)
+        self.active = 0
+        self.first = None
+        self.last = None
+
+class Rolling(Report):
+    # In live mode, the complete slots are summed up by period and each
+    # report covers the last periods (the older ones are forgotten)
+    def __init__(self, windows, export = None):
+        Report.__init__(self, export)
+        self._periods = collections.deque([Period(len(config.events))],
+                                          maxlen = windows)
+
+    def emit(self, timeslots, index, slot):
+        period = self._periods[-1]
+        period.counts += slot
+        period.active += 1
+        if period.first is None:
+            period.first = index
+        period.last = index
+
+        if self._export is not None:
+            self._export.emit(timeslots, index, slot)
+
+    def report(self, timeslots, periodic):
+        total = Timeslot(len(config.events), 0)
+        active = 0
+        for period in self._periods:
+            total += period.counts
+            active += period.active
+        indexes = [p.first for p in self._periods if p.first is not None]
+        indexes += [p.last for p in self._periods if p.last is not None]
+
+        if indexes:
+            print '# === Live: {}-{}ns, {} active slots ==='.format(
+                min(indexes) * config.slot_nsecs,
+                (max(indexes) + 1) * config.slot_nsecs, active)
+        else:
+            print '# === Live: no complete slot ==='
+        cpus = timeslots.cpus()
+        self._print_header(cpus)
+        rows = [total.get_row(timeslots.cpu_index(c)) for c in cpus]
+        rows.append(total.get_total())
+        print '    counts: ' + ' | '.join(
+            [' '.join(['{:03d}'.format(t * config.sample) for t in row])
+             for row in rows])
+        # The live reports go through pipes
+        sys.stdout.flush()
+
+        if periodic:
+            self._periods.append(Period(len(config.events)))
+
+def print_timeslots(timeslots, export = None):
+    print_title()
 
-    names_strings = ['E{:02d}'.format(i) for i, _ in enumerate(names)]
-    names_strings =  ' '.join(names_strings)
-    names_strings = [names_strings] * len(cpus)
-    print '# ns\evts : ' + ' | '.join(names_strings)
+    indexes = timeslots.keys()
+    indexes.sort()
 
+    report = Report(export)
     for index in indexes:
-        slot = timeslots[index]
-        percpu_counts = []
-
-        for cpu in cpus:
-            tmp = [slot[(cpu, n)] for n in names]
-            tmp = ' '.join(['{:03d}'.format(t) for t in tmp])
-            percpu_counts.append(tmp)
+        report.emit(timeslots, index, timeslots[index])
+
+def print_late(timeslots):
+    print '# === Late events: window:{}ns ==='.format(config.window)
+    print ' late : {:04d}'.format(timeslots.late)
+
+def print_profile(timeslots, profile):
+    from PerfExtra.profile import Profile, print_profile_stages
+    print '# === Profile: 1 in {} per-event calls timed ==='.format(
+        Profile.SAMPLING)
+    print_profile_stages(profile, ('unhandled', 'handlers', 'report'),
+                         ('unhandled', 'handlers', 'report'))
+    print ' outside   : {:010d} (out of start= and stop=)'.format(
+        profile.get_calls('outside'))
+    print ' late      : {:010d}'.format(timeslots.late)
+    print ' peak slots: {:010d}'.format(profile.peaks.get('slots', 0))
+
+# --- Export part ---
+
+class Export:
+    # One row per non-zero (slot, cpu, event) counter, the slot being
+    # given by its start time
+    def __init__(self, prefix):
+        header = ['nsecs', 'cpu', 'name', 'count']
+        self._output = open(prefix + '.timeslots.csv', 'wb', 1 << 20)
+        self._table = csv.writer(self._output)
+        self._table.writerow(header)
+        from PerfExtra.output import NpyWriter
+        self._binary = NpyWriter(prefix + '.timeslots.npy', len(header))
+
+    def emit(self, timeslots, index, slot):
+        nsecs = index * timeslots.slot_nsecs
+        for cpu in timeslots.cpus():
+            row = slot.get_row(timeslots.cpu_index(cpu))
+            for i, count in enumerate(row):
+                if count:
+                    count *= config.sample
+                    self._table.writerow([nsecs, cpu, config.events[i], count])
+                    self._binary.append((nsecs, cpu, i, count))
+
+    def close(self):
+        self._output.close()
+        self._binary.close()
 
-        nsecs = (index - indexes[0]) * config.slot_nsecs
-        line = '{:010d}: '.format(nsecs)
-        line += ' | '.join(percpu_counts)
-        print line
 
 # --- Perf related part ---
 
 timeslots = None
+rolling = None
+export = None
+cache = None
 config = None
+profile = None
+
+# The trace time bounds and the events sampling (there are no cycles
+# here: each event is one, sampled by its cpu and timestamp), with the
+# blocks selection
+start = 0
+stop = float('inf')
+sampled = None
+select = None
 
 def trace_unhandled(event_name, context, fields):
-    args = (event_name, 
-            context,
-            fields['common_cpu'],
-            Util.nsecs(fields['common_s'], fields['common_ns']),
-            fields['common_pid'], fields['common_comm'])
-    event = Event(*args)
+    # The cache keeps every event, whatever the configuration
+    if cache is not None:
+        cache.append(event_name, fields['common_cpu'],
+                     Util.nsecs(fields['common_s'], fields['common_ns']),
+                     fields['common_pid'], fields['common_comm'])
+
+    # Out of bounds and sampled out events are dropped before any
+    # processing
+    nsecs = Util.nsecs(fields['common_s'], fields['common_ns'])
+    if not start <= nsecs < stop:
+        if profile is not None:
+            profile.stats('outside')[0] += 1
+        return
+    if sampled is not None and not sampled(fields['common_cpu'], nsecs):
+        return
+
+    event = Event(event_name,
+                  context,
+                  fields['common_cpu'],
+                  nsecs,
+                  fields['common_pid'], fields['common_comm'])
     timeslots.append(event)
 
+
+def get_batch_ids():
+    # The front-ends (see replay.py) may push blocks of events through
+    # trace_batch() with these name ids, unless every event must go
+    # through the handlers (cache or profiling)
+    if cache or profile:
+        return None
+    return timeslots.ids
+
+def trace_batch(columns):
+    if select is not None:
+        columns = select(columns)
+        if columns is None:
+            return
+    timeslots.append_many(columns)
+
 def trace_begin():
     # Parse the script-specific options
     global config
     config = Options(sys.argv[1:])
 
-    # Instanciate the global events holder
-    global timeslots
-    timeslots = Timeslots(config.slot_nsecs)
+    global profile
+    if config.profile:
+        from PerfExtra.profile import Profile
+        profile = Profile()
+
+    global cache
+    if config.cache:
+        from PerfExtra.output import Cache
+        cache = Cache(config.cache)
+
+    global export
+    if config.output:
+        export = Export(config.output)
+
+    global start, stop, sampled, select
+    start, stop = config.start, config.stop
+    if config.sample > 1:
+        from PerfExtra.sampling import new_sampler
+        sampled = new_sampler(config.sample)
+    if start > 0 or stop < float('inf') or sampled is not None:
+        from PerfExtra.sampling import new_selector
+        select = new_selector(start, stop, sampled)
+
+    # Instanciate the global events holder; in streaming mode, the
+    # slots are printed as soon as they are complete, in live mode they
+    # are summed up in the periodic reports
+    global timeslots, rolling
+    if config.live:
+        from PerfExtra.live import Clock, catch_signals
+        print_legend()
+        rolling = Rolling(config.live[1], export)
+        clock = Clock(config.live[0], config.window)
+        timeslots = Timeslots(config.slot_nsecs, config.events,
+                              config.window, rolling.emit, clock,
+                              rolling.report)
+        catch_signals(clock)
+    elif config.stream:
+        print_legend()
+        print_title()
+        emit = Report(export).emit
+        if config.profile:
+            peak = lambda timeslots, index, slot: \
+                profile.peak('slots', len(timeslots.timeslots))
+            emit = profile.time('report', emit, probe = peak)
+        timeslots = Timeslots(config.slot_nsecs, config.events,
+                              config.window, emit)
+    else:
+        timeslots = Timeslots(config.slot_nsecs, config.events)
+
+    # The profiled stages are wrapped (only then, to leave the normal
+    # path untouched)
+    if config.profile:
+        globals()['trace_unhandled'] = profile.time(
+            'unhandled', trace_unhandled, Profile.SAMPLING)
+        globals()['print_timeslots'] = profile.time('report',
+                                                    print_timeslots)
+
+    # The configured events get their own handler, unless the cache
+    # needs every event (the other ones still mark the slots active)
+    if not cache:
+        for name in config.events:
+            name = name.replace(':', '__')
+            stats = profile.stats('handlers') if profile else None
+            outside = profile.stats('outside') if profile else None
+            globals()[name] = new_handler(name, timeslots.append, stats,
+                                          start, stop, sampled, outside)
 
 def trace_end():
-    print_legend()
-    print_timeslots(timeslots)
+    if cache is not None:
+        cache.close()
+
+    if config.live:
+        timeslots.flush()
+        rolling.report(timeslots, False)
+        print_late(timeslots)
+    elif config.stream:
+        timeslots.flush()
+        print_late(timeslots)
+    else:
+        print_legend()
+        print_timeslots(timeslots, export)
+
+    if export is not None:
+        export.close()
+    if config.snapshot:
+        from PerfExtra.snapshot import save
+        save(config.snapshot, os.path.basename(__file__), sys.argv[1:],
+             timeslots)
+
+    if profile is not None:
+        if not (config.stream or config.live):
+            profile.peak('slots', len(timeslots.timeslots))
+        print_profile(timeslots, profile)
 
-    